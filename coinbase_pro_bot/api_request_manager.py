@@ -1,74 +1,183 @@
-from time import sleep
-import cbpro
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
 from crypto_worker import PriorityCryptoWorker
+from crypto_mailbox import PRIORITY_LANE, DEFAULT_LANE
 from crypto_message import *
+import metrics
 from crypto_logger import logger
+from client_pool import ClientPool
+from order_executor import OrderExecutor
+from response_cache import ResponseCache, request_key
+from rate_limiter import (
+    RateLimiter,
+    RateLimitExceeded,
+    is_rate_limited_response,
+    PUBLIC_ENDPOINT,
+    PRIVATE_ENDPOINT,
+)
 
-MAX_INVESTMENT = 10
+ENDPOINT_CLASSES = {
+    HistoricalDataRequestMessage: PUBLIC_ENDPOINT,
+    ProductTickerRequestMessage: PUBLIC_ENDPOINT,
+    AccountBalanceRequestMessage: PRIVATE_ENDPOINT,
+}
+
+# Handed straight to the OrderExecutor instead of queueing behind market data
+ORDER_MESSAGES = (BuyOrderRequestMessage, SellOrderRequestMessage)
 
 class ApiRequestManager(PriorityCryptoWorker):
 
-    def __init__(self, key_file):
+    # With concurrency > 1 requests are dispatched to a pool of that many
+    # threads, each borrowing its own client from the client pool. A
+    # client_factory, e.g. ExchangeSimulator.create_client, replaces the
+    # authenticated cbpro clients and the key file is then not read.
+    def __init__(self, key_file, concurrency=1, client_factory=None):
         super().__init__(self)
         self.key = None
         self.b64secret = None
         self.passphrase = None
         self.client = None
+        self.client_pool = None
+        self.concurrency = concurrency
+        self.client_factory = client_factory or self.create_client
+        self.executor = None
+        self.dispatch_slots = threading.BoundedSemaphore(concurrency)
+        self.rate_limiter = RateLimiter()
+        self.response_cache = ResponseCache()
+        self.queued_time = {}
+        self.queued_time_lock = threading.Lock()
 
-        self.load_keys_from_file(key_file)
+        if client_factory is None:
+            self.load_keys_from_file(key_file)
         self.initialize_client()
+        self.order_executor = OrderExecutor(self.client_factory, self.rate_limiter)
 
     def load_keys_from_file(self, key_file):
         with open(key_file, 'r') as f:
             lines = f.readlines()
             [self.key, self.b64secret, self.passphrase] = [x.strip() for x in lines][:3]
 
-    def initialize_client(self):
-        self.client = cbpro.AuthenticatedClient(
+    def create_client(self):
+        import cbpro
+
+        return cbpro.AuthenticatedClient(
             self.key,
             self.b64secret,
             self.passphrase
         )
 
+    def initialize_client(self):
+        self.client_pool = ClientPool(self.client_factory, self.concurrency)
+        self.client = self.client_pool.clients[0]
+        if self.concurrency > 1:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.concurrency,
+                thread_name_prefix='ApiRequest'
+            )
+
+    def add_message_to_queue(self, msg):
+        if isinstance(msg, ORDER_MESSAGES):
+            self.order_executor.add_message_to_queue(msg)
+        else:
+            super().add_message_to_queue(msg)
+
+    def add_message_to_priority_queue(self, msg):
+        if isinstance(msg, ORDER_MESSAGES):
+            self.order_executor.add_message_to_queue(msg)
+        else:
+            super().add_message_to_priority_queue(msg)
+
     def get_next_message(self):
-        msg = self.get_next_message_from_priority_queue()
-        if msg is None:
-            msg = self.get_next_message_from_queue()
-        return msg
+        return self.mailbox.get_nowait()
+
+    def request(self, method, *args, **kwargs):
+        with self.client_pool.borrow() as client:
+            if metrics.REGISTRY is None:
+                response = getattr(client, method)(*args, **kwargs)
+            else:
+                started = monotonic()
+                response = getattr(client, method)(*args, **kwargs)
+                metrics.REGISTRY.observe('api_latency_seconds', monotonic() - started, endpoint=method)
+        if is_rate_limited_response(response):
+            raise RateLimitExceeded(response['message'])
+        return response
+
+    def record_queued_time(self, msg):
+        if msg.queued_at is None:
+            return
+        name = msg.__class__.__name__
+        waited = monotonic() - msg.queued_at
+        with self.queued_time_lock:
+            count, total, longest = self.queued_time.get(name, (0, 0.0, 0.0))
+            self.queued_time[name] = (count + 1, total + waited, max(longest, waited))
+
+    # {message type: (requests, total seconds queued, longest seconds queued)}
+    def get_queued_time_stats(self):
+        with self.queued_time_lock:
+            return dict(self.queued_time)
+
+    def build_response(self, msg, data):
+        if isinstance(msg, HistoricalDataRequestMessage):
+            return HistoricalDataResponseMessage(
+                msg.recipient,
+                msg.sender,
+                data,
+                granularity=msg.granularity,
+                start=msg.start,
+                end=msg.end,
+                product_id=msg.product_id,
+            )
+        if isinstance(msg, ProductTickerRequestMessage):
+            return ProductTickerResponseMessage.from_data(msg.recipient, msg.sender, data)
+
+    # Answers msg and every identical request that waited on it
+    def respond(self, msg, data):
+        for waiting in self.response_cache.complete(msg, data):
+            waiting.sender.add_message_to_queue(self.build_response(waiting, data))
+
+    # Answers msg from the response cache, or attaches it to an identical
+    # request in flight. Returns False if msg still has to be sent upstream.
+    def coalesce(self, msg):
+        key = request_key(msg)
+        if key is None:
+            return False
+        data = None if getattr(msg, 'refresh', False) else self.response_cache.get(key)
+        if data is not None:
+            if metrics.REGISTRY is not None:
+                metrics.REGISTRY.increment('response_cache_hits_total', request=key[0])
+            msg.sender.add_message_to_queue(self.build_response(msg, data))
+            return True
+        if self.response_cache.join(msg):
+            return False
+        if metrics.REGISTRY is not None:
+            metrics.REGISTRY.increment('coalesced_requests_total', request=key[0])
+        return True
 
     def process_historical_data_request(self, msg):
 
-        historical_data = self.client.get_product_historic_rates(
+        historical_data = self.request(
+            'get_product_historic_rates',
             msg.product_id,
             start=msg.start,
             end=msg.end,
             granularity=msg.granularity
         )
 
-        response_msg = HistoricalDataResponseMessage(
-            msg.recipient,
-            msg.sender,
-            historical_data
-        )
-        msg.sender.add_message_to_queue(response_msg)
+        self.respond(msg, historical_data)
 
     def process_product_ticker_request(self, msg):
 
-        product_ticker_data = self.client.get_product_ticker(
+        product_ticker_data = self.request(
+            'get_product_ticker',
             msg.product_id
         )
 
-        response_msg = ProductTickerResponseMessage(
-            msg.recipient,
-            msg.sender,
-            product_ticker_data
-        )
-
-        msg.sender.add_message_to_queue(response_msg)
+        self.respond(msg, product_ticker_data)
 
     def process_account_balance_request(self, msg):
 
-        account_balance_data = self.client.get_accounts()
+        account_balance_data = self.request('get_accounts')
 
         response_msg = AccountBalanceResponseMessage(
             msg.recipient,
@@ -78,27 +187,7 @@ class ApiRequestManager(PriorityCryptoWorker):
 
         msg.sender.add_message_to_queue(response_msg)
 
-    def process_buy_order_request(self, msg):
-
-        buy_order_response = self.client.place_market_order(
-            msg.product_id,
-            'buy',
-            funds=MAX_INVESTMENT,
-        )
-
-        logger.info(buy_order_response)
-
-    def process_sell_order_request(self, msg):
-
-        sell_order_response = self.client.place_market_order(
-            msg.product_id,
-            'sell',
-            size
-        )
-
-
-    def process_next_message(self):
-        msg = self.get_next_message()
+    def process_message(self, msg):
         if msg is not None:
             if isinstance(msg, HistoricalDataRequestMessage):
                 self.process_historical_data_request(msg)
@@ -106,15 +195,62 @@ class ApiRequestManager(PriorityCryptoWorker):
                 self.process_product_ticker_request(msg)
             if isinstance(msg, AccountBalanceRequestMessage):
                 self.process_account_balance_request(msg)
-            if isinstance(msg, BuyOrderRequestMessage):
-                self.process_buy_order_request(msg)
-            if isinstance(msg, SellOrderRequestMessage):
-                self.process_sell_order_request(msg)
+
+    # A rate limit response backs the endpoint's bucket off and puts the
+    # message back at the head of its lane
+    def execute(self, msg, endpoint):
+        try:
+            self.process_message(msg)
+        except RateLimitExceeded as e:
+            backoff = self.rate_limiter.rate_limited(endpoint)
+            if metrics.REGISTRY is not None:
+                metrics.REGISTRY.increment('rate_limited_responses_total', endpoint=endpoint)
+            logger.warning(f"{self} hit the {endpoint} rate limit ({e}), backing off {backoff}s")
+            lane = PRIORITY_LANE if endpoint == PRIVATE_ENDPOINT else DEFAULT_LANE
+            self.mailbox.requeue(msg, lane)
+        except Exception:
+            logger.exception(f"{self} failed to process {msg}")
+            dropped = self.response_cache.abandon(msg)
+            if len(dropped) > 0:
+                logger.warning(f"{self} dropped {len(dropped)} requests waiting on {msg}")
+        else:
+            self.rate_limiter.succeeded(endpoint)
+        finally:
+            self.dispatch_slots.release()
+
+    # Waits for a token from the message's endpoint bucket rather than a
+    # fixed delay, so the queue drains as fast as the exchange allows. A
+    # message is only taken off the mailbox once a dispatch slot is free, so
+    # priority messages always go out ahead of anything queued after them.
+    def process_next_message(self, timeout=None):
+        self.dispatch_slots.acquire()
+        msg = self.wait_for_message(timeout)
+        if msg is None:
+            self.dispatch_slots.release()
+            return
+        endpoint = ENDPOINT_CLASSES.get(type(msg))
+        if endpoint is None:
+            self.dispatch_slots.release()
+            self.process_message(msg)
+            return
+        if self.coalesce(msg):
+            self.dispatch_slots.release()
+            return
+        self.rate_limiter.acquire(endpoint)
+        self.record_queued_time(msg)
+        if self.executor is None:
+            self.execute(msg, endpoint)
+        else:
+            self.executor.submit(self.execute, msg, endpoint)
 
     def run(self):
         logger.info(f"{self} starting")
+        self.order_executor.start()
         while not self.is_shutdown():
             self.process_next_message()
-            sleep(1/3)
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        self.order_executor.stop()
+        self.order_executor.join()
         logger.info("DONE")
 
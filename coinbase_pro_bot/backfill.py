@@ -0,0 +1,199 @@
+import json
+import os
+from datetime import datetime
+from time import monotonic
+
+import numpy as np
+
+from candle_cache import CandleCache
+from candle_store import CandleSeries
+from crypto_worker import CryptoWorker
+from crypto_message import HistoricalDataRequestMessage, HistoricalDataResponseMessage
+from crypto_logger import logger
+from utilities import MAX_CANDLES_PER_REQUEST, isoformat
+
+# Pages requested but not yet answered, so a long backfill never crowds the
+# live monitors' requests out of the ApiRequestManager queue
+MAX_PAGES_IN_FLIGHT = 8
+MAX_PAGE_ATTEMPTS = 5
+# Seconds to wait for a page before asking again. A request that fails in
+# the ApiRequestManager is dropped without an answer.
+PAGE_TIMEOUT = 60
+# Pages older than the cached candles are held in memory and merged into the
+# cache in one rewrite per this many pages, instead of one rewrite per page
+MAX_BUFFERED_PAGES = 100
+
+
+# Splits [start, end] into inclusive (start, end) epoch ranges of at most
+# page_size candles, aligned to the granularity
+def page_ranges(start, end, granularity, page_size=MAX_CANDLES_PER_REQUEST):
+    start = start - start % granularity
+    pages = []
+    while start <= end:
+        page_end = min(start + (page_size - 1)*granularity, end)
+        pages.append((start, page_end))
+        start = page_end + granularity
+    return pages
+
+
+# Fetches a long date range for one product/granularity into the candle cache
+# as a series of max size pages. Several pages are requested at once and left
+# to the ApiRequestManager's rate limits; answers are written to the cache
+# strictly in page order and the end of the written range is checkpointed, so
+# an interrupted backfill resumes after the last written page, even if it is
+# restarted with a different end.
+class CandleBackfill(CryptoWorker):
+
+    def __init__(self, client, product_id, granularity, start, end,
+                 candle_cache=None, on_progress=None, max_in_flight=MAX_PAGES_IN_FLIGHT,
+                 page_timeout=PAGE_TIMEOUT):
+        super().__init__(client)
+        self.product_id = product_id
+        self.granularity = granularity
+        self.candle_cache = candle_cache or CandleCache()
+        self.on_progress = on_progress
+        self.max_in_flight = max_in_flight
+        self.page_timeout = page_timeout
+        self.pages = page_ranges(int(start), int(end), granularity)
+        self.pages_written = self.load_progress()
+        self.next_page = self.pages_written
+        # Pages received in order but not yet merged into the cache
+        self.buffered = []
+        # page index -> monotonic time it was requested
+        self.in_flight = {}
+        self.received = {}
+        self.attempts = {}
+
+    def __str__(self):
+        return f"CandleBackfill({self.product_id},{self.granularity})"
+
+    def get_metrics_label(self):
+        return f"CandleBackfill/{self.product_id}/{self.granularity}"
+
+    # Pages only depend on the start, so progress is kept per start and any
+    # later end can resume from it
+    def progress_file(self):
+        start = self.pages[0][0] if len(self.pages) > 0 else 0
+        return f"{self.candle_cache.path(self.product_id, self.granularity)}.{start}.backfill"
+
+    # Returns the number of leading pages that end within the written range
+    def load_progress(self):
+        try:
+            with open(self.progress_file(), 'r') as f:
+                written_until = int(json.load(f)['written_until'])
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            return 0
+        written = 0
+        while written < len(self.pages) and self.pages[written][1] <= written_until:
+            written += 1
+        return written
+
+    def save_progress(self):
+        file_name = self.progress_file()
+        os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+        with open(file_name + '.tmp', 'w') as f:
+            json.dump({'written_until': self.pages[self.pages_written - 1][1]}, f)
+        os.replace(file_name + '.tmp', file_name)
+
+    def is_complete(self):
+        return self.pages_written >= len(self.pages)
+
+    def pages_ready(self):
+        return self.pages_written + len(self.buffered)
+
+    def request_page(self, index):
+        start, end = self.pages[index]
+        self.attempts[index] = self.attempts.get(index, 0) + 1
+        self.in_flight[index] = monotonic()
+        self.client.add_message_to_queue(HistoricalDataRequestMessage(
+            self,
+            self.client,
+            self.product_id,
+            granularity=self.granularity,
+            start=isoformat(start),
+            end=isoformat(end),
+        ))
+
+    def fill_window(self):
+        while len(self.in_flight) < self.max_in_flight and self.next_page < len(self.pages):
+            self.request_page(self.next_page)
+            self.next_page += 1
+
+    def page_index(self, msg):
+        start = int(datetime.fromisoformat(msg.start).timestamp())
+        for index in self.in_flight:
+            if self.pages[index][0] == start:
+                return index
+        return None
+
+    # Pages newer than everything cached are appended right away; older ones
+    # are buffered and merged in batches, since every merge rewrites the file
+    def write_pages(self):
+        while self.pages_ready() in self.received:
+            candles = self.received.pop(self.pages_ready())
+            start, end = self.pages[self.pages_ready()]
+            candles = candles[(candles.timestamp >= start) & (candles.timestamp <= end)]
+            if len(self.buffered) == 0 and start > self.candle_cache.last_timestamp(self.product_id, self.granularity):
+                self.candle_cache.append(self.product_id, self.granularity, candles)
+                self.pages_written += 1
+                self.save_progress()
+            else:
+                self.buffered.append(candles)
+            logger.info(f"{self} received page {self.pages_ready()}/{len(self.pages)}")
+            if self.on_progress is not None:
+                self.on_progress(self.pages_ready(), len(self.pages))
+        if len(self.buffered) >= MAX_BUFFERED_PAGES or self.pages_ready() >= len(self.pages):
+            self.flush()
+
+    def flush(self):
+        if len(self.buffered) == 0:
+            return
+        candles = CandleSeries(*[np.concatenate([getattr(page, col) for page in self.buffered])
+                                 for col in CandleSeries.__slots__])
+        self.candle_cache.merge(self.product_id, self.granularity, candles)
+        self.pages_written += len(self.buffered)
+        self.buffered = []
+        self.save_progress()
+        logger.info(f"{self} wrote pages up to {self.pages_written}/{len(self.pages)}")
+
+    def process_message(self, msg):
+        if not isinstance(msg, HistoricalDataResponseMessage) or msg.start is None:
+            return
+        index = self.page_index(msg)
+        if index is None:
+            return
+        del self.in_flight[index]
+        if not isinstance(msg.data, list):
+            self.retry_page(index, msg.data)
+            return
+        self.received[index] = CandleSeries.from_list(msg.data)
+        self.write_pages()
+
+    def retry_page(self, index, reason):
+        if self.attempts[index] >= MAX_PAGE_ATTEMPTS:
+            logger.error(f"{self} giving up on page {index}: {reason}")
+            self.stop()
+            return
+        self.request_page(index)
+
+    # Seconds until the oldest page in flight times out
+    def get_timeout(self):
+        if len(self.in_flight) == 0:
+            return None
+        return max(min(self.in_flight.values()) + self.page_timeout - monotonic(), 0)
+
+    def retry_timed_out_pages(self):
+        now = monotonic()
+        for index, requested_at in list(self.in_flight.items()):
+            if now - requested_at >= self.page_timeout and not self.is_shutdown():
+                del self.in_flight[index]
+                self.retry_page(index, f"no answer after {self.page_timeout}s")
+
+    def run(self):
+        logger.info(f"{self} backfilling {len(self.pages) - self.pages_written} of {len(self.pages)} pages")
+        while not self.is_shutdown() and not self.is_complete():
+            self.fill_window()
+            self.process_message(self.wait_for_message(self.get_timeout()))
+            self.retry_timed_out_pages()
+        self.flush()
+        logger.info(f"{self} finished with {self.pages_written}/{len(self.pages)} pages")
@@ -0,0 +1,203 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from candle_cache import CandleCache
+from data_processing import determine_next_state_from_values
+from indicators import macd, rsi, rolling_slope, indicator_warmup
+from utilities import (
+    FIAT_MARKETS,
+    STATE_DEFAULT,
+    STATE_OVERBOUGHT,
+    STATE_OVERSOLD,
+    STATE_SELL_INDICATED,
+    STATE_BUY_INDICATED,
+    STATE_SELL,
+    STATE_BUY,
+    MAX_INVESTMENT,
+    MAX_CANDLES_PER_REQUEST,
+    DEFAULT_PARAMETERS,
+)
+
+# Taker fee charged on both sides of a market order
+FEE_RATE = 0.005
+
+Trade = namedtuple('Trade', ['timestamp', 'side', 'price', 'size', 'funds'])
+
+
+class BacktestResult(object):
+
+    def __init__(self, product_id, granularity, trades, last_price, investment):
+        self.product_id = product_id
+        self.granularity = granularity
+        self.trades = trades
+        self.last_price = last_price
+        self.investment = investment
+
+    def __str__(self):
+        return (f"BacktestResult({self.product_id},{self.granularity}: "
+                f"{len(self.trades)} trades, pnl {self.pnl():.4f})")
+
+    def open_size(self):
+        if len(self.trades) > 0 and self.trades[-1].side == 'buy':
+            return self.trades[-1].size
+        return 0.0
+
+    def realized_pnl(self):
+        return sum(sell.funds - buy.funds for buy, sell in self.round_trips())
+
+    # Realized PnL plus any open position marked at the last close
+    def pnl(self):
+        if self.open_size() == 0:
+            return self.realized_pnl()
+        return self.realized_pnl() - self.trades[-1].funds + self.open_size()*self.last_price
+
+    def round_trips(self):
+        buys = [t for t in self.trades if t.side == 'buy']
+        sells = [t for t in self.trades if t.side == 'sell']
+        return list(zip(buys, sells))
+
+    def win_rate(self):
+        round_trips = self.round_trips()
+        if len(round_trips) == 0:
+            return np.nan
+        return sum(1 for buy, sell in round_trips if sell.funds > buy.funds)/len(round_trips)
+
+    def summary(self):
+        return {
+            'product_id': self.product_id,
+            'granularity': self.granularity,
+            'trades': len(self.trades),
+            'pnl': self.pnl(),
+            'win_rate': self.win_rate(),
+        }
+
+
+# Replays the CryptoMonitor decision logic with every candle close standing in
+# for a ticker price. A state only changes on the candle where its exit
+# condition first holds, so rather than stepping through every candle the
+# simulation jumps straight to the next such candle using precomputed masks.
+def simulate(timestamps, closes, rsi_line, macd_diff, slopes, start,
+             parameters=DEFAULT_PARAMETERS, investment=MAX_INVESTMENT, fee_rate=FEE_RATE):
+    oversold = parameters.rsi_oversold
+    overbought = parameters.rsi_overbought
+    with np.errstate(invalid='ignore'):
+        tradable = ~(slopes/closes < parameters.trend_threshold)
+        events = {
+            STATE_DEFAULT: tradable & ((rsi_line >= overbought) | (rsi_line <= oversold)),
+            STATE_OVERBOUGHT: tradable & (rsi_line < overbought),
+            STATE_OVERSOLD: tradable & (rsi_line > oversold),
+            STATE_SELL_INDICATED: tradable & (macd_diff < 0),
+            STATE_BUY_INDICATED: tradable & (macd_diff > 0),
+        }
+    event_indices = {state: np.flatnonzero(mask) for state, mask in events.items()}
+
+    trades = []
+    state = STATE_DEFAULT
+    owned = 0.0
+    i = start
+    while True:
+        indices = event_indices[state]
+        k = np.searchsorted(indices, i)
+        if k == len(indices):
+            break
+        i = int(indices[k])
+        price = float(closes[i])
+        next_state = determine_next_state_from_values(rsi_line[i], macd_diff[i], state, oversold, overbought)
+        if next_state == STATE_BUY:
+            if owned > 0:
+                # The live monitor stays in this state for good
+                break
+            owned = investment*(1 - fee_rate)/price
+            trades.append(Trade(int(timestamps[i]), 'buy', price, owned, investment))
+            state = STATE_DEFAULT
+        elif next_state == STATE_SELL:
+            if owned == 0:
+                break
+            trades.append(Trade(int(timestamps[i]), 'sell', price, owned, owned*price*(1 - fee_rate)))
+            owned = 0.0
+            state = STATE_DEFAULT
+        else:
+            state = next_state
+        i += 1
+    return trades
+
+
+def get_warmup(parameters):
+    return indicator_warmup(parameters.macd_fast, parameters.macd_slow, parameters.macd_signal, parameters.rsi_period)
+
+
+# A live monitor fits its trend over the history window past the indicator
+# warmup, plus the ticker price
+def get_trend_window(parameters):
+    return MAX_CANDLES_PER_REQUEST - get_warmup(parameters) + 1
+
+
+# Indicator arrays for one close series, computed on first use so parameter
+# combinations that share periods share the arrays
+class IndicatorCache(object):
+
+    def __init__(self, closes):
+        self.closes = closes
+        self.macd_diffs = {}
+        self.rsi_lines = {}
+        self.slopes = {}
+
+    def macd_diff(self, fast, slow, signal):
+        key = (fast, slow, signal)
+        if key not in self.macd_diffs:
+            _, _, macd_line, signal_line = macd(self.closes, fast, slow, signal)
+            self.macd_diffs[key] = macd_line - signal_line
+        return self.macd_diffs[key]
+
+    def rsi(self, period):
+        if period not in self.rsi_lines:
+            self.rsi_lines[period] = rsi(self.closes, period)[0]
+        return self.rsi_lines[period]
+
+    def slope(self, window):
+        if window not in self.slopes:
+            self.slopes[window] = rolling_slope(self.closes, window)
+        return self.slopes[window]
+
+
+def backtest(candles, product_id=None, granularity=None, parameters=DEFAULT_PARAMETERS,
+             investment=MAX_INVESTMENT, fee_rate=FEE_RATE, indicator_cache=None):
+    if len(candles) == 0:
+        return BacktestResult(product_id, granularity, [], np.nan, investment)
+    if indicator_cache is None:
+        indicator_cache = IndicatorCache(candles.close)
+    trend_window = get_trend_window(parameters)
+    trades = simulate(
+        candles.timestamp,
+        candles.close,
+        indicator_cache.rsi(parameters.rsi_period),
+        indicator_cache.macd_diff(parameters.macd_fast, parameters.macd_slow, parameters.macd_signal),
+        indicator_cache.slope(trend_window),
+        max(get_warmup(parameters), trend_window - 1),
+        parameters=parameters,
+        investment=investment,
+        fee_rate=fee_rate,
+    )
+    return BacktestResult(product_id, granularity, trades, float(candles.close[-1]), investment)
+
+
+def backtest_cached(job):
+    product_id, granularity, base_dir, kwargs = job
+    candles = CandleCache(base_dir).load(product_id, granularity)
+    return backtest(candles, product_id, granularity, **kwargs)
+
+
+# Runs every product/granularity pair stored in the candle cache on its own
+# process, loading the candles inside the worker so nothing large is pickled
+def run_backtests(product_ids, granularities, base_dir=None, processes=None, **kwargs):
+    jobs = [(product_id, granularity, base_dir, kwargs)
+            for product_id in product_ids for granularity in granularities]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(backtest_cached, jobs))
+
+
+if __name__ == "__main__":
+    results = run_backtests([f"{crypto}-USD" for crypto in FIAT_MARKETS], [3600])
+    for result in sorted(results, key=lambda r: r.pnl() if not np.isnan(r.pnl()) else -np.inf, reverse=True):
+        print(result)
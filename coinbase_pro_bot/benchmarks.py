@@ -0,0 +1,202 @@
+import json
+import os
+import platform
+import sys
+import threading
+from datetime import datetime, timezone
+from statistics import median
+from time import perf_counter, time
+
+import numpy as np
+import pandas as pd
+
+from crypto_worker import CryptoWorker
+from crypto_monitor import CryptoMonitor
+from crypto_message import CryptoMessage, ProductTickerResponseMessage
+from data_processing import (
+    list_to_dataframe,
+    calculate_ema,
+    calculate_macd,
+    calculate_rsi,
+    gather_all_crypto_data,
+    determine_next_state,
+)
+from utilities import BASE_CSV_DATA, STATE_DEFAULT
+
+BENCHMARK_DIR = os.path.join(BASE_CSV_DATA, "benchmarks")
+
+SIZES = (300, 10_000, 1_000_000)
+MARKET_COUNTS = (1, 10, 50, 200)
+REPEAT = 5
+QUEUE_MESSAGES = 100_000
+# Slower than this relative to the baseline counts as a regression
+REGRESSION_RATIO = 1.2
+
+
+# Random walk candles in the exchange's format, newest first, so every run
+# benchmarks the same data
+def synthetic_candles(count, granularity=3600, seed=0, start=1_500_000_000):
+    rng = np.random.default_rng(seed)
+    closes = 100*np.exp(np.cumsum(rng.normal(0, 0.01, count)))
+    opens = np.concatenate(([100.0], closes[:-1]))
+    spread = np.abs(rng.normal(0, 0.005, count))*closes
+    highs = np.maximum(opens, closes) + spread
+    lows = np.minimum(opens, closes) - spread
+    volumes = rng.uniform(1, 1000, count)
+    timestamps = start + granularity*np.arange(count)
+    return [[int(t), l, h, o, c, v] for t, l, h, o, c, v in
+            zip(timestamps[::-1], lows[::-1], highs[::-1], opens[::-1], closes[::-1], volumes[::-1])]
+
+
+# Stands in for the ApiRequestManager, recording what monitors send it
+class StubClient(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.orders = 0
+
+    def __str__(self):
+        return "StubClient"
+
+    def add_message_to_queue(self, msg):
+        self.requests += 1
+
+    def add_message_to_priority_queue(self, msg):
+        self.orders += 1
+
+
+class CountingWorker(CryptoWorker):
+
+    def __init__(self, client, expected, done):
+        super().__init__(client)
+        self.expected = expected
+        self.received = 0
+        self.done = done
+
+    def run(self):
+        while self.received < self.expected:
+            if self.wait_for_message() is not None:
+                self.received += 1
+        self.done.release()
+
+
+# Runs fn repeat times and returns the timings in seconds
+def measure(fn, repeat=REPEAT):
+    timings = []
+    for _ in range(repeat):
+        started = perf_counter()
+        fn()
+        timings.append(perf_counter() - started)
+    return timings
+
+
+def result(name, timings, items, **params):
+    best = min(timings)
+    return dict(params, benchmark=name, repeat=len(timings), min=best, median=median(timings),
+                items=items, items_per_second=items/best if best > 0 else float('inf'))
+
+
+def benchmark_indicators(size, repeat=REPEAT):
+    candles = synthetic_candles(size)
+    df = list_to_dataframe(candles)
+    full = gather_all_crypto_data(df)
+    benchmarks = [
+        ('list_to_dataframe', lambda: list_to_dataframe(candles)),
+        ('calculate_ema', lambda: calculate_ema(df, 12, 'close', 'ema_12')),
+        ('calculate_macd', lambda: calculate_macd(df)),
+        ('calculate_rsi', lambda: calculate_rsi(df)),
+        ('gather_all_crypto_data', lambda: gather_all_crypto_data(df)),
+        ('determine_next_state', lambda: determine_next_state(full, STATE_DEFAULT)),
+    ]
+    return [result(name, measure(fn, repeat), size, candles=size) for name, fn in benchmarks]
+
+
+# One ticker evaluated by every monitor, each holding a full window of history
+def benchmark_monitors(markets, repeat=REPEAT):
+    client = StubClient()
+    monitors = []
+    for i in range(markets):
+        monitor = CryptoMonitor(client, f"SYN{i}-USD", 3600)
+        monitor.load_history(synthetic_candles(300, seed=i))
+        monitors.append(monitor)
+    tickers = [ProductTickerResponseMessage(client, m, float(m.candles.close[-1]*1.001)) for m in monitors]
+
+    def tick():
+        for monitor, msg in zip(monitors, tickers):
+            monitor.process_message(msg)
+
+    return result('monitor_ticker', measure(tick, repeat), markets, markets=markets)
+
+
+# QUEUE_MESSAGES spread round robin over one worker thread per market
+def benchmark_queue_throughput(markets, messages=QUEUE_MESSAGES, repeat=REPEAT):
+    client = StubClient()
+    messages = messages - messages % markets
+
+    def run():
+        done = threading.Semaphore(0)
+        workers = [CountingWorker(client, messages//markets, done) for _ in range(markets)]
+        for worker in workers:
+            worker.start()
+        for i in range(messages):
+            workers[i % markets].add_message_to_queue(CryptoMessage(client, workers[i % markets]))
+        for _ in workers:
+            done.acquire()
+
+    return result('crypto_worker_queue', measure(run, repeat), messages, markets=markets)
+
+
+def run_benchmarks(sizes=SIZES, market_counts=MARKET_COUNTS, repeat=REPEAT):
+    results = []
+    for size in sizes:
+        # A million candles takes long enough that one run is stable
+        results.extend(benchmark_indicators(size, repeat if size < 1_000_000 else 1))
+    for markets in market_counts:
+        results.append(benchmark_monitors(markets, repeat))
+        results.append(benchmark_queue_throughput(markets, repeat=repeat))
+    return {
+        'time': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def save_results(report, file_name=None):
+    if file_name is None:
+        file_name = os.path.join(BENCHMARK_DIR, f"benchmark-{int(time())}.json")
+    os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+    with open(file_name, 'w') as f:
+        json.dump(report, f, indent=2)
+    return file_name
+
+
+def result_key(r):
+    return (r['benchmark'], r.get('candles'), r.get('markets'))
+
+
+# Returns (benchmark key, baseline seconds, current seconds, ratio) for every
+# benchmark in both reports, slowest relative to the baseline first
+def compare(baseline, current):
+    before = {result_key(r): r['min'] for r in baseline['results']}
+    rows = [(result_key(r), before[result_key(r)], r['min'], r['min']/before[result_key(r)])
+            for r in current['results'] if result_key(r) in before and before[result_key(r)] > 0]
+    return sorted(rows, key=lambda row: row[3], reverse=True)
+
+
+# python benchmarks.py [baseline.json] runs the suite, saves the results and
+# lists anything that got slower than the baseline
+if __name__ == "__main__":
+    report = run_benchmarks()
+    print(f"Saved {save_results(report)}")
+    for r in report['results']:
+        print(f"{r['benchmark']:<24} candles={r.get('candles', '-'):<8} markets={r.get('markets', '-'):<4} "
+              f"min={r['min']*1000:10.3f}ms  {r['items_per_second']:14.0f}/s")
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'r') as f:
+            baseline = json.load(f)
+        for key, before, after, ratio in compare(baseline, report):
+            if ratio > REGRESSION_RATIO:
+                print(f"REGRESSION {key}: {before*1000:.3f}ms -> {after*1000:.3f}ms ({ratio:.2f}x)")
@@ -0,0 +1,151 @@
+from crypto_message import (
+    ProductTickerResponseMessage,
+    CandleUpdateMessage,
+    MarketDataGapMessage,
+    new_message,
+    release_message,
+)
+from crypto_logger import logger
+from utilities import GRANULARITIES
+
+
+class Candle(object):
+
+    __slots__ = ['start', 'open', 'high', 'low', 'close', 'volume']
+
+    def __init__(self, start, open, high, low, close, volume=0.0):
+        self.start = start
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+
+    def __str__(self):
+        return f"Candle({self.start},{self.open},{self.high},{self.low},{self.close},{self.volume})"
+
+    @classmethod
+    def from_candle(cls, start, candle):
+        return cls(start, candle.open, candle.high, candle.low, candle.close, candle.volume)
+
+    def update(self, price, size):
+        self.high = max(self.high, price)
+        self.low = min(self.low, price)
+        self.close = price
+        self.volume += size
+
+    def merge(self, candle):
+        self.high = max(self.high, candle.high)
+        self.low = min(self.low, candle.low)
+        self.close = candle.close
+        self.volume += candle.volume
+
+
+# Builds candles for every granularity from a single trade stream. Trades
+# only ever touch the finest candle; each closed candle is rolled into the
+# next coarser one, so every granularity must be a multiple of the previous.
+# Candles that began before started_at, by default the first trade's time,
+# only saw part of their trades and are never reported closed; their
+# granularities are collected in `skipped` instead.
+class CandleAggregator(object):
+
+    def __init__(self, granularities=GRANULARITIES, started_at=None):
+        self.granularities = sorted(granularities)
+        for finer, coarser in zip(self.granularities, self.granularities[1:]):
+            if coarser % finer != 0:
+                raise ValueError(f"granularity {coarser} is not a multiple of {finer}")
+        self.current = [None for _ in self.granularities]
+        self.started_at = started_at
+        self.late_trades = 0
+        self.partial_candles = 0
+        self.skipped = []
+
+    # Closes every candle that ends at or before `now`, returning a list of
+    # (granularity, Candle) from finest to coarsest
+    def advance(self, now):
+        closed = []
+        incoming = None
+        for level, granularity in enumerate(self.granularities):
+            current = self.current[level]
+            if incoming is not None and current is not None \
+                    and incoming.start - incoming.start % granularity == current.start:
+                current.merge(incoming)
+                incoming = None
+            outgoing = None
+            if current is not None and now >= current.start + granularity:
+                outgoing = current
+                self.current[level] = None
+                if current.start >= self.started_at:
+                    closed.append((granularity, current))
+                else:
+                    self.partial_candles += 1
+                    self.skipped.append(granularity)
+            if incoming is not None:
+                self.current[level] = Candle.from_candle(incoming.start - incoming.start % granularity, incoming)
+            incoming = outgoing
+        return closed
+
+    def add_trade(self, timestamp, price, size=0.0):
+        if self.started_at is None:
+            self.started_at = timestamp
+        closed = self.advance(timestamp)
+        base = self.granularities[0]
+        current = self.current[0]
+        if current is None:
+            self.current[0] = Candle(timestamp - timestamp % base, price, price, price, price, size)
+        elif timestamp < current.start:
+            self.late_trades += 1
+        else:
+            current.update(price, size)
+        return closed
+
+    def get_open_candle(self, granularity):
+        return self.current[self.granularities.index(granularity)]
+
+
+# Sits between a MarketDataFeed and the monitors of one product, turning its
+# trade stream into CandleUpdateMessages for each registered granularity.
+class CandleBuilder(object):
+
+    def __init__(self, product_id, granularities=GRANULARITIES):
+        self.product_id = product_id
+        self.aggregator = CandleAggregator(granularities)
+        self.subscribers = {}
+
+    def __str__(self):
+        return f"CandleBuilder({self.product_id})"
+
+    def register(self, granularity, worker):
+        if granularity not in self.aggregator.granularities:
+            raise ValueError(f"{self} does not build {granularity}s candles")
+        self.subscribers.setdefault(granularity, []).append(worker)
+
+    def all_subscribers(self):
+        return [worker for workers in self.subscribers.values() for worker in workers]
+
+    def publish(self, closed):
+        for granularity, candle in closed:
+            for worker in self.subscribers.get(granularity, []):
+                worker.add_message_to_queue(new_message(CandleUpdateMessage, self, worker, granularity, candle))
+
+    # A skipped partial candle leaves a hole in the sequence the monitors
+    # see, which only REST can fill
+    def report_skipped(self):
+        for granularity in self.aggregator.skipped:
+            for worker in self.subscribers.get(granularity, []):
+                worker.add_message_to_queue(MarketDataGapMessage(self, worker, self.product_id))
+        self.aggregator.skipped = []
+
+    # Called from the feed thread in place of a worker's queue
+    def add_message_to_queue(self, msg):
+        if isinstance(msg, ProductTickerResponseMessage):
+            if msg.time is not None:
+                self.publish(self.aggregator.add_trade(int(msg.time), msg.price, msg.size))
+                if len(self.aggregator.skipped) > 0:
+                    self.report_skipped()
+            release_message(msg)
+        elif isinstance(msg, MarketDataGapMessage):
+            logger.info(f"{self} lost trades, monitors will backfill over REST")
+            self.aggregator = CandleAggregator(self.aggregator.granularities)
+            for worker in self.all_subscribers():
+                worker.add_message_to_queue(MarketDataGapMessage(self, worker, self.product_id))
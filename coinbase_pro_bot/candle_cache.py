@@ -0,0 +1,120 @@
+import os
+import numpy as np
+
+from candle_store import CandleSeries
+from utilities import generate_file_name, generate_binary_file_name
+
+# Fixed size little-endian records, appended in timestamp order, so the file
+# can be read with a single np.fromfile/memmap and its last timestamp found
+# with one seek
+CANDLE_RECORD = np.dtype([
+    ('timestamp', '<i8'),
+    ('open', '<f8'),
+    ('high', '<f8'),
+    ('low', '<f8'),
+    ('close', '<f8'),
+    ('volume', '<f8'),
+])
+
+CSV_HEADER = 'timestamp,open,high,low,close,volume'
+
+
+def records_to_series(records):
+    return CandleSeries(*[np.array(records[col]) for col in CANDLE_RECORD.names])
+
+
+def series_to_records(candles):
+    records = np.empty(len(candles), dtype=CANDLE_RECORD)
+    for col in CANDLE_RECORD.names:
+        records[col] = getattr(candles, col)
+    return records
+
+
+class CandleCache(object):
+
+    def __init__(self, base_dir=None):
+        self.base_dir = base_dir
+
+    def path(self, pair, granularity):
+        file_name = generate_binary_file_name(pair, granularity)
+        if self.base_dir is not None:
+            file_name = os.path.join(self.base_dir, os.path.basename(file_name))
+        return file_name
+
+    def last_timestamp(self, pair, granularity):
+        try:
+            with open(self.path(pair, granularity), 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell() - f.tell() % CANDLE_RECORD.itemsize
+                if size == 0:
+                    return 0
+                f.seek(size - CANDLE_RECORD.itemsize)
+                return int(np.frombuffer(f.read(CANDLE_RECORD.itemsize), dtype=CANDLE_RECORD)['timestamp'][0])
+        except FileNotFoundError:
+            return 0
+
+    # Memory maps the file instead of reading it, so only the pages of the
+    # requested range are ever touched
+    def load(self, pair, granularity, since=0):
+        file_name = self.path(pair, granularity)
+        if not os.path.exists(file_name):
+            return CandleSeries.empty()
+        count = os.path.getsize(file_name) // CANDLE_RECORD.itemsize
+        if count == 0:
+            return CandleSeries.empty()
+        records = np.memmap(file_name, dtype=CANDLE_RECORD, mode='r', shape=(count,))
+        start = np.searchsorted(records['timestamp'], since)
+        return records_to_series(records[start:])
+
+    # Only candles newer than the last stored one are written, so callers can
+    # hand over overlapping windows
+    def append(self, pair, granularity, candles):
+        last = self.last_timestamp(pair, granularity)
+        candles = candles[candles.timestamp > last]
+        if len(candles) == 0:
+            return 0
+        file_name = self.path(pair, granularity)
+        os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+        with open(file_name, 'ab') as f:
+            series_to_records(candles).tofile(f)
+        return len(candles)
+
+    # Like append, but candles older than the last stored one are merged in
+    # as well, by rewriting the file in timestamp order. Stored candles win
+    # over new ones with the same timestamp. Returns the number of candles
+    # added.
+    def merge(self, pair, granularity, candles):
+        if len(candles) == 0 or candles.timestamp.min() > self.last_timestamp(pair, granularity):
+            return self.append(pair, granularity, candles)
+        stored = series_to_records(self.load(pair, granularity))
+        new = series_to_records(candles)
+        _, first = np.unique(new['timestamp'], return_index=True)
+        new = new[first]
+        new = new[~np.isin(new['timestamp'], stored['timestamp'])]
+        if len(new) == 0:
+            return 0
+        records = np.concatenate((stored, new))
+        records = records[np.argsort(records['timestamp'], kind='stable')]
+        file_name = self.path(pair, granularity)
+        os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+        with open(file_name + '.tmp', 'wb') as f:
+            records.tofile(f)
+        os.replace(file_name + '.tmp', file_name)
+        return len(new)
+
+    def export_csv(self, pair, granularity, file_name=None):
+        file_name = file_name or generate_file_name(pair, granularity)
+        records = series_to_records(self.load(pair, granularity))
+        os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+        np.savetxt(file_name, records, delimiter=',', header=CSV_HEADER, comments='',
+                   fmt=['%d'] + ['%.17g']*5)
+        return len(records)
+
+    def import_csv(self, pair, granularity, file_name=None):
+        file_name = file_name or generate_file_name(pair, granularity)
+        rows = np.loadtxt(file_name, delimiter=',', skiprows=1, ndmin=2)
+        if len(rows) == 0:
+            return 0
+        rows = rows[np.argsort(rows[:, 0], kind='stable')]
+        candles = CandleSeries(*[rows[:, i] for i in range(len(CANDLE_RECORD.names))])
+        return self.append(pair, granularity, candles)
@@ -0,0 +1,83 @@
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+
+# Column order of the rows returned by get_product_historic_rates
+RAW_CANDLE_COLUMNS = ['timestamp', 'low', 'high', 'open', 'close', 'volume']
+PRICE_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+
+
+# Columnar OHLCV series, oldest candle first. Timestamps are int64 epoch
+# seconds and prices float64, so a 300 candle series is ~14KB instead of
+# 1800 Decimal objects inside an object-dtype DataFrame.
+class CandleSeries(object):
+
+    __slots__ = ['timestamp', 'open', 'high', 'low', 'close', 'volume']
+
+    def __init__(self, timestamp, open, high, low, close, volume):
+        self.timestamp = np.asarray(timestamp, dtype=np.int64)
+        self.open = np.asarray(open, dtype=np.float64)
+        self.high = np.asarray(high, dtype=np.float64)
+        self.low = np.asarray(low, dtype=np.float64)
+        self.close = np.asarray(close, dtype=np.float64)
+        self.volume = np.asarray(volume, dtype=np.float64)
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], [], [], [], [])
+
+    @classmethod
+    def from_list(cls, lst):
+        if len(lst) == 0:
+            return cls.empty()
+        raw = np.array(lst, dtype=np.float64)
+        # The exchange returns newest first; only fall back to a real sort
+        # if that ever stops being true
+        cols = np.ascontiguousarray(raw[::-1].T)
+        if np.any(np.diff(cols[0]) < 0):
+            cols = cols[:, np.argsort(cols[0], kind='stable')]
+        return cls(
+            cols[0],
+            cols[3],
+            cols[2],
+            cols[1],
+            cols[4],
+            cols[5],
+        )
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def __getitem__(self, key):
+        return CandleSeries(*[getattr(self, col)[key] for col in self.__slots__])
+
+    def __str__(self):
+        return f"CandleSeries({len(self)} candles)"
+
+    def append(self, timestamp, open, high, low, close, volume):
+        values = [timestamp, open, high, low, close, volume]
+        for col, value in zip(self.__slots__, values):
+            setattr(self, col, np.append(getattr(self, col), value).astype(getattr(self, col).dtype))
+
+    # Candles from `other` replace any of ours at or after its first timestamp
+    def merge(self, other):
+        if len(other) == 0:
+            return self[:]
+        head = self[self.timestamp < other.timestamp[0]]
+        return CandleSeries(*[np.concatenate((getattr(head, col), getattr(other, col))) for col in self.__slots__])
+
+    def last_timestamp(self):
+        if len(self) == 0:
+            return 0
+        return int(self.timestamp[-1])
+
+    def last_time(self):
+        return datetime.fromtimestamp(self.last_timestamp(), tz=timezone.utc)
+
+    def nbytes(self):
+        return sum(getattr(self, col).nbytes for col in self.__slots__)
+
+    def to_dataframe(self):
+        df = pd.DataFrame({col: getattr(self, col) for col in PRICE_COLUMNS})
+        df.insert(0, 'timestamp', pd.to_datetime(self.timestamp, unit='s', utc=True))
+        return df
@@ -0,0 +1,26 @@
+from contextlib import contextmanager
+from queue import Queue
+
+
+# Fixed set of API clients handed out one caller at a time. Each client keeps
+# its own keep-alive HTTP session, so concurrent requests never share a
+# connection and never pay for a new TLS handshake.
+class ClientPool(object):
+
+    def __init__(self, factory, size=1):
+        self.size = size
+        self.clients = [factory() for _ in range(size)]
+        self.available = Queue()
+        for client in self.clients:
+            self.available.put(client)
+
+    def __len__(self):
+        return self.size
+
+    @contextmanager
+    def borrow(self):
+        client = self.available.get()
+        try:
+            yield client
+        finally:
+            self.available.put(client)
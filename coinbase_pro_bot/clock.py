@@ -0,0 +1,38 @@
+from time import time, monotonic
+
+# Market time for everything that reasons about candles. None means the real
+# wall clock; a simulation installs a SimulatedClock to run the bot faster
+# than real time against the exchange simulator.
+CLOCK = None
+
+
+# Wall clock that starts at `start` and runs `speed` times faster than real
+# time
+class SimulatedClock(object):
+
+    def __init__(self, speed=1.0, start=None):
+        self.speed = speed
+        self.start = time() if start is None else start
+        self.started_at = monotonic()
+
+    def time(self):
+        return self.start + (monotonic() - self.started_at)*self.speed
+
+
+def install(clock):
+    global CLOCK
+    CLOCK = clock
+
+
+def uninstall():
+    global CLOCK
+    CLOCK = None
+
+
+def now():
+    return time() if CLOCK is None else CLOCK.time()
+
+
+# Real seconds to wait for `seconds` of market time to pass
+def real_seconds(seconds):
+    return seconds if CLOCK is None else seconds/CLOCK.speed
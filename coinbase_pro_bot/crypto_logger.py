@@ -1,18 +1,215 @@
+import atexit
+import json
 import logging
+import multiprocessing
+import os
+import threading
+from logging.handlers import QueueHandler
+from queue import SimpleQueue, Empty
+from time import time
+
+LOG_FILE = 'logs/crypto_monitor.log'
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Records written per file write
+LOG_BATCH_SIZE = 512
+# Rotate once the file reaches this size or age, whichever comes first
+MAX_LOG_BYTES = 50*1024*1024
+LOG_ROTATE_SECONDS = 24*60*60
+LOG_BACKUP_COUNT = 7
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'logger': record.name,
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry)
+
+
+# Only renders the message text on the logging thread, everything else,
+# including timestamps and file I/O, is left to the listener. The queue is
+# unbounded, so logging never blocks the caller.
+class NonBlockingQueueHandler(QueueHandler):
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# Appends to file_name and rotates it to file_name.1 ... file_name.N by
+# size or age
+class RotatingLogWriter(object):
+
+    def __init__(self, file_name, max_bytes=MAX_LOG_BYTES, rotate_seconds=LOG_ROTATE_SECONDS,
+                 backup_count=LOG_BACKUP_COUNT):
+        self.file_name = file_name
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count
+        self.file = None
+        self.size = 0
+        self.opened_at = 0
+        self.open()
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.file_name) or '.', exist_ok=True)
+        self.file = open(self.file_name, 'a', encoding='utf-8')
+        self.size = self.file.tell()
+        self.opened_at = time()
+
+    def should_rotate(self):
+        return self.size >= self.max_bytes or time() - self.opened_at >= self.rotate_seconds
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.file_name}.{i}"):
+                os.replace(f"{self.file_name}.{i}", f"{self.file_name}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.file_name, f"{self.file_name}.1")
+        else:
+            os.remove(self.file_name)
+        self.open()
+
+    def write(self, text):
+        if self.size > 0 and self.should_rotate():
+            self.rotate()
+        self.file.write(text)
+        self.file.flush()
+        self.size += len(text)
+
+    def close(self):
+        self.file.close()
+
+
+# Drains the record queue on its own thread, formatting whatever has piled up
+# and writing it to the log file in one write
+class LogListener(threading.Thread):
+
+    def __init__(self, records, writer, formatter, batch_size=LOG_BATCH_SIZE):
+        super().__init__(name='LogListener', daemon=True)
+        self.records = records
+        self.writer = writer
+        self.formatter = formatter
+        self.batch_size = batch_size
+
+    def next_batch(self):
+        batch = [self.records.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.records.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def run(self):
+        running = True
+        while running:
+            lines = []
+            for record in self.next_batch():
+                if record is None:
+                    running = False
+                    continue
+                lines.append(self.formatter.format(record) + '\n')
+            if len(lines) > 0:
+                self.writer.write(''.join(lines))
+        self.writer.close()
+
+    def stop(self):
+        self.records.put(None)
+        self.join()
+
+
+# Runs in the process that owns the LogListener and moves records logged by
+# its forked children onto the listener's queue
+class ChildRecordForwarder(threading.Thread):
+
+    def __init__(self, child_records, records):
+        super().__init__(name='ChildRecordForwarder', daemon=True)
+        self.child_records = child_records
+        self.records = records
+
+    def run(self):
+        while True:
+            record = self.child_records.get()
+            if record is None:
+                break
+            self.records.put(record)
+
+    def stop(self):
+        self.child_records.put(None)
+        self.join()
+
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# create console handler and set level to debug
-ch = logging.FileHandler('logs/crypto_monitor.log')
-#ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
+listener = None
+handler = None
+# Set up before the first fork. Forked children have no listener thread, so
+# their handler is pointed at child_records, which the forwarder drains into
+# the parent's listener.
+child_records = None
+forwarder = None
+
+
+def stop_logging():
+    global listener, forwarder, child_records
+    if forwarder is not None:
+        forwarder.stop()
+        forwarder = None
+        child_records = None
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def before_fork():
+    global child_records, forwarder
+    if listener is None or forwarder is not None:
+        return
+    child_records = multiprocessing.Queue()
+    forwarder = ChildRecordForwarder(child_records, listener.records)
+    forwarder.start()
+
+
+def after_fork_in_child():
+    global listener, forwarder
+    listener = None
+    forwarder = None
+    if handler is not None and child_records is not None:
+        handler.queue = child_records
+
 
-# create formatter
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Replaces the logger's handlers with a queue feeding a background listener
+def configure_logging(file_name=LOG_FILE, json_format=False, level=logging.INFO,
+                      max_bytes=MAX_LOG_BYTES, rotate_seconds=LOG_ROTATE_SECONDS,
+                      backup_count=LOG_BACKUP_COUNT):
+    global listener, handler
+    stop_logging()
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    records = SimpleQueue()
+    formatter = JsonFormatter() if json_format else logging.Formatter(LOG_FORMAT)
+    writer = RotatingLogWriter(file_name, max_bytes, rotate_seconds, backup_count)
+    listener = LogListener(records, writer, formatter)
+    listener.start()
+    handler = NonBlockingQueueHandler(records)
+    handler.setLevel(level)
+    logger.addHandler(handler)
 
-# add formatter to ch
-ch.setFormatter(formatter)
 
-# add ch to logger
-logger.addHandler(ch)
+configure_logging()
+atexit.register(stop_logging)
+os.register_at_fork(before=before_fork, after_in_child=after_fork_in_child)
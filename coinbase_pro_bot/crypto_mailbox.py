@@ -0,0 +1,65 @@
+import threading
+from collections import deque
+
+PRIORITY_LANE = 0
+DEFAULT_LANE = 1
+
+
+# Multi-lane FIFO guarded by a single condition variable. get() always drains
+# lower numbered lanes first and blocks without polling until a message
+# arrives, the timeout expires or the mailbox is closed.
+class Mailbox(object):
+
+    def __init__(self, lanes=2):
+        self.lanes = [deque() for _ in range(lanes)]
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def __len__(self):
+        with self.cond:
+            return sum(len(lane) for lane in self.lanes)
+
+    def lane_length(self, lane):
+        with self.cond:
+            return len(self.lanes[lane])
+
+    def put(self, msg, lane=DEFAULT_LANE):
+        with self.cond:
+            self.lanes[lane].append(msg)
+            self.cond.notify()
+
+    # Puts a message back at the head of its lane, e.g. after a failed attempt
+    def requeue(self, msg, lane=DEFAULT_LANE):
+        with self.cond:
+            self.lanes[lane].appendleft(msg)
+            self.cond.notify()
+
+    def pop_next(self):
+        for lane in self.lanes:
+            if lane:
+                return lane.popleft()
+        return None
+
+    def get_nowait(self, lane=None):
+        with self.cond:
+            if lane is None:
+                return self.pop_next()
+            if self.lanes[lane]:
+                return self.lanes[lane].popleft()
+            return None
+
+    def get(self, timeout=None):
+        with self.cond:
+            self.cond.wait_for(
+                lambda: self.closed or any(self.lanes),
+                timeout=timeout
+            )
+            return self.pop_next()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def is_closed(self):
+        return self.closed
@@ -1,8 +1,152 @@
+import json
+import struct
+from collections import namedtuple
+from math import isnan, nan
+from time import monotonic
+
+import dateutil.parser
+
+
+def feed_timestamp(value):
+    return dateutil.parser.isoparse(value).timestamp()
+
+
+# Binary encodings of single field values. encode appends bytes to a list,
+# decode reads one value from a buffer at an offset and returns it with the
+# offset after it. None survives every codec.
+Codec = namedtuple('Codec', ['encode', 'decode'])
+
+INT_FORMAT = struct.Struct('<?q')
+FLOAT_FORMAT = struct.Struct('<d')
+LENGTH_FORMAT = struct.Struct('<i')
+CANDLE_FORMAT = struct.Struct('<q5d')
+ROWS_FORMAT = struct.Struct('<BII')
+
+ROWS_ARRAY = 0
+ROWS_JSON = 1
+# Columns of an exchange candle: time, low, high, open, close, volume
+CANDLE_COLUMNS = 6
+
+
+def encode_int(value, out):
+    out.append(INT_FORMAT.pack(value is not None, value or 0))
+
+
+def decode_int(buf, offset):
+    present, value = INT_FORMAT.unpack_from(buf, offset)
+    return (value if present else None), offset + INT_FORMAT.size
+
+
+# None is carried as NaN
+def encode_float(value, out):
+    out.append(FLOAT_FORMAT.pack(nan if value is None else value))
+
+
+def decode_float(buf, offset):
+    value, = FLOAT_FORMAT.unpack_from(buf, offset)
+    return (None if isnan(value) else value), offset + FLOAT_FORMAT.size
+
+
+def encode_bytes(data, out):
+    if data is None:
+        out.append(LENGTH_FORMAT.pack(-1))
+        return
+    out.append(LENGTH_FORMAT.pack(len(data)))
+    out.append(data)
+
+
+def decode_bytes(buf, offset):
+    length, = LENGTH_FORMAT.unpack_from(buf, offset)
+    offset += LENGTH_FORMAT.size
+    if length < 0:
+        return None, offset
+    return bytes(buf[offset:offset + length]), offset + length
+
+
+# Anything else is sent as its str(), e.g. Decimal order sizes
+def encode_text(value, out):
+    encode_bytes(None if value is None else str(value).encode(), out)
+
+
+def decode_text(buf, offset):
+    data, offset = decode_bytes(buf, offset)
+    return (None if data is None else data.decode()), offset
+
+
+def encode_json(value, out):
+    encode_bytes(None if value is None else json.dumps(value, separators=(',', ':')).encode(), out)
+
+
+def decode_json(buf, offset):
+    data, offset = decode_bytes(buf, offset)
+    return (None if data is None else json.loads(data)), offset
+
+
+def encode_candle(candle, out):
+    if candle is None:
+        out.append(b'\x00')
+        return
+    out.append(b'\x01')
+    out.append(CANDLE_FORMAT.pack(candle.start, candle.open, candle.high, candle.low, candle.close, candle.volume))
+
+
+def decode_candle(buf, offset):
+    from candle_builder import Candle
+
+    if buf[offset] == 0:
+        return None, offset + 1
+    values = CANDLE_FORMAT.unpack_from(buf, offset + 1)
+    return Candle(*values), offset + 1 + CANDLE_FORMAT.size
+
+
+# Exchange candles, a list of [time, low, high, open, close, volume], are
+# packed as float64 rows with integer times restored on the way back. Error
+# responses and anything else shaped differently go as JSON.
+def encode_rows(data, out):
+    if isinstance(data, list) and all(isinstance(row, (list, tuple)) and len(row) == CANDLE_COLUMNS for row in data):
+        try:
+            values = struct.pack(f"<{len(data)*CANDLE_COLUMNS}d", *(value for row in data for value in row))
+        except struct.error:
+            values = None
+        if values is not None:
+            out.append(ROWS_FORMAT.pack(ROWS_ARRAY, len(data), CANDLE_COLUMNS))
+            out.append(values)
+            return
+    out.append(ROWS_FORMAT.pack(ROWS_JSON, 0, 0))
+    encode_json(data, out)
+
+
+def decode_rows(buf, offset):
+    kind, rows, columns = ROWS_FORMAT.unpack_from(buf, offset)
+    offset += ROWS_FORMAT.size
+    if kind == ROWS_JSON:
+        return decode_json(buf, offset)
+    values = struct.unpack_from(f"<{rows*columns}d", buf, offset)
+    data = [[int(values[i])] + list(values[i + 1:i + columns]) for i in range(0, rows*columns, columns)]
+    return data, offset + rows*columns*FLOAT_FORMAT.size
+
+
+INT = Codec(encode_int, decode_int)
+FLOAT = Codec(encode_float, decode_float)
+TEXT = Codec(encode_text, decode_text)
+JSON = Codec(encode_json, decode_json)
+CANDLE = Codec(encode_candle, decode_candle)
+ROWS = Codec(encode_rows, decode_rows)
+
+
 class CryptoMessage(object):
 
+    __slots__ = ('sender', 'recipient', 'queued_at')
+
+    # Constructor arguments after sender and recipient, in order, and the
+    # codec of each. Used to carry messages across process boundaries.
+    fields = ()
+    codecs = ()
+
     def __init__(self, sender, recipient):
         self.sender = sender
         self.recipient = recipient
+        self.queued_at = None
 
     def __str__(self):
         return f"({self.sender} --{self.__class__.__name__}--> {self.recipient})"
@@ -10,43 +154,125 @@ class CryptoMessage(object):
 
 class HistoricalDataRequestMessage(CryptoMessage):
 
-    def __init__(self, sender, recipient, product_id, granularity=None, start=None, end=None):
+    fields = ('product_id', 'granularity', 'start', 'end', 'refresh')
+    codecs = (TEXT, INT, TEXT, TEXT, INT)
+    __slots__ = fields
+
+    # refresh skips cached responses, for asking again after an answer that
+    # was missing the newest candle
+    def __init__(self, sender, recipient, product_id, granularity=None, start=None, end=None, refresh=False):
         super().__init__(sender, recipient)
         self.product_id = product_id
         self.granularity = granularity
         self.start = start
         self.end = end
+        self.refresh = refresh
 
 
 class HistoricalDataResponseMessage(CryptoMessage):
 
-    def __init__(self, sender, recipient, data):
+    fields = ('data', 'granularity', 'start', 'end', 'product_id')
+    codecs = (ROWS, INT, TEXT, TEXT, TEXT)
+    __slots__ = fields
+
+    # granularity, start, end and product_id echo the request this answers
+    def __init__(self, sender, recipient, data, granularity=None, start=None, end=None, product_id=None):
         super().__init__(sender, recipient)
         self.data = data
+        self.granularity = granularity
+        self.start = start
+        self.end = end
+        self.product_id = product_id
 
 
 class ProductTickerRequestMessage(CryptoMessage):
 
+    fields = ('product_id',)
+    codecs = (TEXT,)
+    __slots__ = fields
+
     def __init__(self, sender, recipient, product_id):
         super().__init__(sender, recipient)
         self.product_id = product_id
 
 
+# A trade price from the REST ticker or the websocket feed. time is in epoch
+# seconds and None if the source didn't say; price is None and error holds
+# the exchange's message if the request failed.
 class ProductTickerResponseMessage(CryptoMessage):
 
-    def __init__(self, sender, recipient, data):
+    fields = ('price', 'size', 'time', 'error')
+    codecs = (FLOAT, FLOAT, FLOAT, TEXT)
+    __slots__ = fields
+
+    def __init__(self, sender, recipient, price, size=0.0, time=None, error=None):
+        super().__init__(sender, recipient)
+        self.price = price
+        self.size = size
+        self.time = time
+        self.error = error
+
+    # Parses a ticker response or a feed ticker/match message
+    @classmethod
+    def from_data(cls, sender, recipient, data):
+        if 'price' not in data:
+            return new_message(cls, sender, recipient, None, error=data.get('message', 'no price'))
+        return new_message(
+            cls,
+            sender,
+            recipient,
+            float(data['price']),
+            float(data.get('last_size', data.get('size', 0.0))),
+            feed_timestamp(data['time']) if 'time' in data else None,
+        )
+
+
+class CandleUpdateMessage(CryptoMessage):
+
+    fields = ('granularity', 'candle')
+    codecs = (INT, CANDLE)
+    __slots__ = fields
+
+    def __init__(self, sender, recipient, granularity, candle):
+        super().__init__(sender, recipient)
+        self.granularity = granularity
+        self.candle = candle
+
+
+class MarketDataGapMessage(CryptoMessage):
+
+    fields = ('product_id',)
+    codecs = (TEXT,)
+    __slots__ = fields
+
+    def __init__(self, sender, recipient, product_id):
+        super().__init__(sender, recipient)
+        self.product_id = product_id
+
+
+# Sent by a TimerWheel when a worker's scheduled time comes up
+class TimerMessage(CryptoMessage):
+
+    __slots__ = ()
+
+    def __init__(self, sender, recipient):
         super().__init__(sender, recipient)
-        self.data = data
 
 
 class AccountBalanceRequestMessage(CryptoMessage):
 
+    __slots__ = ()
+
     def __init__(self, sender, recipient):
         super().__init__(sender, recipient)
 
 
 class AccountBalanceResponseMessage(CryptoMessage):
 
+    fields = ('data',)
+    codecs = (JSON,)
+    __slots__ = fields
+
     def __init__(self, sender, recipient, data):
         super().__init__(sender, recipient)
         self.data = data
@@ -54,13 +280,26 @@ class AccountBalanceResponseMessage(CryptoMessage):
 
 class BuyOrderRequestMessage(CryptoMessage):
 
-    def __init__(self, sender, recipient, product_id):
+    fields = ('product_id', 'funds', 'signaled_at')
+    codecs = (TEXT, TEXT, FLOAT)
+    __slots__ = fields
+
+    # signaled_at is when the monitor decided to trade, for latency tracking.
+    # It is carried to other processes as is, the monotonic clock is shared
+    # by every process on the host.
+    def __init__(self, sender, recipient, product_id, funds=None, signaled_at=None):
         super().__init__(sender, recipient)
         self.product_id = product_id
+        self.funds = funds
+        self.signaled_at = monotonic() if signaled_at is None else signaled_at
 
 
 class BuyOrderResponseMessage(CryptoMessage):
 
+    fields = ('data',)
+    codecs = (JSON,)
+    __slots__ = fields
+
     def __init__(self, sender, recipient, data):
         super().__init__(sender, recipient)
         self.data = data
@@ -68,13 +307,23 @@ class BuyOrderResponseMessage(CryptoMessage):
 
 class SellOrderRequestMessage(CryptoMessage):
 
-    def __init__(self, sender, recipient, product_id):
+    fields = ('product_id', 'size', 'signaled_at')
+    codecs = (TEXT, TEXT, FLOAT)
+    __slots__ = fields
+
+    def __init__(self, sender, recipient, product_id, size=None, signaled_at=None):
         super().__init__(sender, recipient)
         self.product_id = product_id
+        self.size = size
+        self.signaled_at = monotonic() if signaled_at is None else signaled_at
 
 
 class SellOrderResponseMessage(CryptoMessage):
 
+    fields = ('data',)
+    codecs = (JSON,)
+    __slots__ = fields
+
     def __init__(self, sender, recipient, data):
         super().__init__(sender, recipient)
         self.data = data
@@ -82,5 +331,114 @@ class SellOrderResponseMessage(CryptoMessage):
 
 class ShutdownMessage(CryptoMessage):
 
-    def __init__(sender, recipient):
+    __slots__ = ()
+
+    def __init__(self, sender, recipient):
         super().__init__(sender, recipient)
+
+
+# The position of a type in this registry is its id in the binary encoding,
+# so new types go at the end
+MESSAGE_TYPES = {cls.__name__: cls for cls in [
+    HistoricalDataRequestMessage,
+    HistoricalDataResponseMessage,
+    ProductTickerRequestMessage,
+    ProductTickerResponseMessage,
+    CandleUpdateMessage,
+    MarketDataGapMessage,
+    TimerMessage,
+    AccountBalanceRequestMessage,
+    AccountBalanceResponseMessage,
+    BuyOrderRequestMessage,
+    BuyOrderResponseMessage,
+    SellOrderRequestMessage,
+    SellOrderResponseMessage,
+    ShutdownMessage,
+]}
+MESSAGE_CLASSES = list(MESSAGE_TYPES.values())
+MESSAGE_IDS = {cls: type_id for type_id, cls in enumerate(MESSAGE_CLASSES)}
+
+TYPE_FORMAT = struct.Struct('<B')
+
+
+# One type id byte followed by each field in its codec's encoding. Sender and
+# recipient are live worker objects and never leave the process, the
+# receiving side supplies its own stand-ins when rebuilding the message.
+# Process local state such as queued_at is left out too.
+def message_to_bytes(msg):
+    out = [TYPE_FORMAT.pack(MESSAGE_IDS[msg.__class__])]
+    for field, codec in zip(msg.fields, msg.codecs):
+        codec.encode(getattr(msg, field), out)
+    return b''.join(out)
+
+
+def message_from_bytes(buf, sender, recipient, offset=0):
+    cls = MESSAGE_CLASSES[buf[offset]]
+    offset += TYPE_FORMAT.size
+    values = []
+    for codec in cls.codecs:
+        value, offset = codec.decode(buf, offset)
+        values.append(value)
+    return new_message(cls, sender, recipient, *values)
+
+
+# Set by enable_pooling. Pooling is off by default, in which case
+# new_message and release_message fall through to plain construction.
+POOL = None
+
+POOL_CAPACITY = 256
+
+
+# Free lists of spent messages per type. A released message has its
+# references cleared and is handed out again by acquire with fresh
+# arguments, saving the allocation for high volume types like tickers.
+# Only the final consumer of a message may release it, and only once.
+class MessagePool(object):
+
+    def __init__(self, capacity=POOL_CAPACITY):
+        self.capacity = capacity
+        self.free = {cls: [] for cls in MESSAGE_CLASSES}
+        self.reused = 0
+
+    def acquire(self, cls, sender, recipient, *args, **kwargs):
+        free = self.free.get(cls)
+        try:
+            msg = free.pop()
+        except (AttributeError, IndexError):
+            return cls(sender, recipient, *args, **kwargs)
+        msg.__init__(sender, recipient, *args, **kwargs)
+        self.reused += 1
+        return msg
+
+    def release(self, msg):
+        free = self.free.get(msg.__class__)
+        if free is None or len(free) >= self.capacity:
+            return
+        msg.sender = msg.recipient = None
+        for field in msg.fields:
+            setattr(msg, field, None)
+        free.append(msg)
+
+
+def enable_pooling(capacity=POOL_CAPACITY):
+    global POOL
+    POOL = MessagePool(capacity)
+    return POOL
+
+
+def disable_pooling():
+    global POOL
+    POOL = None
+
+
+def new_message(cls, sender, recipient, *args, **kwargs):
+    pool = POOL
+    if pool is None:
+        return cls(sender, recipient, *args, **kwargs)
+    return pool.acquire(cls, sender, recipient, *args, **kwargs)
+
+
+def release_message(msg):
+    pool = POOL
+    if pool is not None and msg is not None:
+        pool.release(msg)
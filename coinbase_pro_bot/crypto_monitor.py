@@ -1,8 +1,6 @@
-from time import sleep
+from time import monotonic
 from datetime import datetime, timezone
-import dateutil.parser
 from decimal import Decimal
-import numpy as np
 
 from crypto_worker import CryptoWorker
 from crypto_message import (
@@ -11,13 +9,24 @@ from crypto_message import (
     HistoricalDataResponseMessage,
     ProductTickerRequestMessage,
     ProductTickerResponseMessage,
+    CandleUpdateMessage,
+    MarketDataGapMessage,
+    TimerMessage,
     BuyOrderRequestMessage,
     BuyOrderResponseMessage,
     SellOrderRequestMessage,
     SellOrderResponseMessage,
+    release_message,
 )
+import clock
+import metrics
 from crypto_logger import logger
-from data_processing import gather_all_crypto_data, list_to_dataframe, determine_next_state, save_graphs
+from data_processing import determine_next_state_from_values
+from candle_builder import Candle
+from candle_store import CandleSeries
+from shared_candles import RingBusy
+from indicators import IncrementalIndicators, RollingRegression, indicator_warmup
+from scheduler import next_boundary
 from utilities import (
     STATE_DEFAULT,
     STATE_OVERBOUGHT,
@@ -26,10 +35,17 @@ from utilities import (
     STATE_BUY_INDICATED,
     STATE_SELL,
     STATE_BUY,
+    MAX_CANDLES_PER_REQUEST,
+    DEFAULT_PARAMETERS,
+    isoformat,
 )
 
+# How often the ticker is polled when there is no market feed, and how soon
+# a monitor without any history retries
 SLEEP_TIME = 30
-SLEEP_INTERVAL = 5
+# Seconds after a candle closes before its history is requested, so the
+# exchange has published the new candle
+CANDLE_CLOSE_DELAY = 2
 
 class CryptoMonitor(CryptoWorker):
 
@@ -38,29 +54,154 @@ class CryptoMonitor(CryptoWorker):
         self.product_id = product_id
         self.granularity = granularity
         self.last_time = datetime.fromtimestamp(0, tz=timezone.utc)
-        self.historical_df = None
+        self.candles = None
+        self.indicators = None
+        self.trend = None
         self.state = STATE_DEFAULT
         self.owned_crypto_balance = Decimal(0)
+        # Set from placing an order until its fill (or failure) comes back
+        self.order_pending = False
+        # Optional shared Ledger, read in place of owned_crypto_balance
+        self.ledger = None
+        self.parameters = DEFAULT_PARAMETERS
+        # Set when prices are pushed by a MarketDataFeed instead of polled
+        self.use_ticker_feed = False
+        # Set when closed candles are pushed by a CandleBuilder, in which case
+        # REST history is only fetched to warm up or fill a feed gap
+        self.use_candle_feed = False
+        self.needs_backfill = False
+        # Optional CandleCache to warm start from, only the missing tail is
+        # then requested from the API
+        self.candle_cache = None
+        self.cached_candles = None
+        # Optional shared TimerWheel that wakes the monitor instead of its own
+        # wait timeout, request_offset spreads markets after a candle close
+        self.scheduler = None
+        self.request_offset = 0
+        # Optional SharedCandleRing that an ingest process keeps up to date,
+        # read in place of requesting history
+        self.candle_ring = None
 
     def __str__(self):
         return f"CryptoMonitor({self.get_thread_name()},{self.product_id},{self.granularity})"
 
+    def get_metrics_label(self):
+        return f"{self.product_id}/{self.granularity}"
+
     def round_down_time(self, t):
-        return t.replace(microsecond=0, second=0, minute=0, tzinfo=timezone.utc)
+        if t.tzinfo is None:
+            t = t.replace(tzinfo=timezone.utc)
+        timestamp = int(t.timestamp())
+        return datetime.fromtimestamp(timestamp - timestamp % self.granularity, tz=timezone.utc)
 
     def get_expected_last_time(self):
-        return self.round_down_time(datetime.utcnow())
+        return self.round_down_time(datetime.fromtimestamp(clock.now(), tz=timezone.utc))
+
+    def get_owned_balance(self):
+        if self.ledger is not None:
+            return self.ledger.snapshot().position(self.product_id)
+        return self.owned_crypto_balance
+
+    def get_indicator_warmup(self):
+        p = self.parameters
+        return indicator_warmup(p.macd_fast, p.macd_slow, p.macd_signal, p.rsi_period)
+
+    def needs_history(self):
+        if self.use_candle_feed:
+            return self.candles is None or self.needs_backfill
+        return self.get_expected_last_time() > self.last_time
+
+    def warm_start(self):
+        if self.candle_cache is None:
+            return
+        since = int(clock.now()) - MAX_CANDLES_PER_REQUEST*self.granularity
+        cached = self.candle_cache.load(self.product_id, self.granularity, since)
+        if len(cached) > 0:
+            logger.info(f"{self} loaded {len(cached)} cached candles")
+            self.cached_candles = cached
+
+    def save_candles(self, candles):
+        if self.candle_cache is None:
+            return
+        closed = candles[candles.timestamp + self.granularity <= clock.now()]
+        self.candle_cache.append(self.product_id, self.granularity, closed)
+
+    # Returns the (start, end) to request history for, or (None, None) for the
+    # exchange's default window
+    def get_history_window(self):
+        if self.candles is not None or self.cached_candles is None:
+            return None, None
+        start = self.cached_candles.last_timestamp()
+        end = int(clock.now())
+        if (end - start)//self.granularity >= MAX_CANDLES_PER_REQUEST:
+            return None, None
+        return isoformat(start), isoformat(end)
+
+    def load_history(self, data):
+        candles = CandleSeries.from_list(data)
+        if self.cached_candles is not None:
+            candles = self.cached_candles.merge(candles)[-MAX_CANDLES_PER_REQUEST:]
+            self.cached_candles = None
+        self.save_candles(candles)
+        if self.use_candle_feed:
+            # The newest REST candle is still open, the builder will send it
+            # once it closes
+            candles = candles[candles.timestamp + self.granularity <= clock.now()]
+        self.load_candles(candles)
+
+    def load_candles(self, candles):
+        self.candles = candles
+        self.last_time = candles.last_time()
+        self.indicators = IncrementalIndicators.from_closes(candles.close, self.parameters)
+        trend_closes = candles.close[self.get_indicator_warmup():]
+        self.trend = RollingRegression.from_values(trend_closes, (max(len(trend_closes), 1),))
+        self.needs_backfill = False
+
+    def commit_candle(self, candle):
+        last = self.candles.last_timestamp()
+        if candle.start <= last:
+            return
+        self.candles.append(candle.start, candle.open, candle.high, candle.low, candle.close, candle.volume)
+        self.indicators.commit(candle.close)
+        self.trend.commit(candle.close)
+        self.last_time = self.candles.last_time()
+        self.save_candles(self.candles[-1:])
+
+    # Picks up whatever closed candles the ingest process wrote to the
+    # shared ring since the last read
+    def read_candle_ring(self):
+        try:
+            if self.candles is None:
+                candles = self.candle_ring.snapshot()[-MAX_CANDLES_PER_REQUEST:]
+                if len(candles) > 0:
+                    self.load_candles(candles)
+                return
+            new = self.candle_ring.since(self.candles.last_timestamp())
+        except RingBusy as e:
+            logger.warning(f"{self} could not read its candle ring: {e}")
+            return
+        for i in range(len(new)):
+            self.commit_candle(Candle(int(new.timestamp[i]), new.open[i], new.high[i], new.low[i],
+                                      new.close[i], new.volume[i]))
 
     def request_data(self):
-        if self.get_expected_last_time() > self.last_time:
+        if self.candle_ring is not None:
+            self.read_candle_ring()
+        elif self.needs_history():
+            start, end = self.get_history_window()
             history_request_msg = HistoricalDataRequestMessage(
                 self,
                 self.client,
                 self.product_id,
                 granularity=self.granularity,
+                start=start,
+                end=end,
             )
             self.client.add_message_to_queue(history_request_msg)
 
+        if self.use_ticker_feed:
+            return
+
         product_ticker_msg = ProductTickerRequestMessage(
             self,
             self.client,
@@ -75,41 +216,70 @@ class CryptoMonitor(CryptoWorker):
                 # Check if the most recent time is from after our last most recent
                 # If it is, build a new dataframe and save it. If not, we'll keep
                 # trying until it is
-                if datetime.fromtimestamp(msg.data[0][0], tz=timezone.utc) > self.last_time:
-                    self.historical_df = list_to_dataframe(msg.data)
-                    self.last_time = datetime.fromtimestamp(msg.data[0][0], tz=timezone.utc)
+                if not isinstance(msg.data, list) or len(msg.data) == 0:
+                    logger.warning(f"{self} got no historical data: {msg.data}")
+                elif datetime.fromtimestamp(msg.data[0][0], tz=timezone.utc) > self.last_time:
+                    self.load_history(msg.data)
+            elif isinstance(msg, CandleUpdateMessage):
+                if self.candles is not None and msg.granularity == self.granularity:
+                    self.commit_candle(msg.candle)
+            elif isinstance(msg, MarketDataGapMessage):
+                self.needs_backfill = True
+                self.request_data()
             elif isinstance(msg, ProductTickerResponseMessage):
+                if self.candle_ring is not None:
+                    self.read_candle_ring()
                 # Shouldn't ever get a response for this before a response for
                 # overall historical data
-                if self.historical_df is None:
+                if self.indicators is None:
                     return 1
-                fresh_df = self.historical_df.copy(deep=True)
-                dt = dateutil.parser.isoparse(msg.data['time'])
-                d = "{:.2f}".format(float(msg.data['price']))
-                fresh_df.loc[len(fresh_df)] = [dt, 0, 0, 0, Decimal(d), 0]
-                df = gather_all_crypto_data(fresh_df)
-                z = np.polyfit(df.index, [float(x) for x in df.close], 1)
-                if Decimal(z[0])/Decimal(d) < Decimal(-0.0005):
+                if msg.price is None:
+                    logger.warning(f"{self} got no ticker price: {msg.error}")
+                    return 1
+                started = monotonic() if metrics.REGISTRY is not None else None
+                price = msg.price
+                # Evaluate the ticker as a provisional candle on top of the
+                # committed history without mutating it
+                snapshot = self.indicators.peek(price)
+                slope = self.trend.peek(price)
+                if started is not None:
+                    metrics.REGISTRY.observe('indicator_seconds', monotonic() - started, market=self.get_metrics_label())
+                if slope/price < self.parameters.trend_threshold:
                     logger.warning(f"{self} has a significantly negative trend, "
                                     f"avoiding this market for now")
                     return
-                next_state = determine_next_state(df, self.state)
-                if next_state == STATE_BUY:
-                    if self.owned_crypto_balance.compare(Decimal(0)) == Decimal(1):
+                next_state = determine_next_state_from_values(
+                    snapshot.rsi,
+                    snapshot.macd - snapshot.macd_sig,
+                    self.state,
+                    self.parameters.rsi_oversold,
+                    self.parameters.rsi_overbought,
+                )
+                if next_state in (STATE_BUY, STATE_SELL) and self.order_pending:
+                    logger.info(f"{self} is still waiting on its last order")
+                elif next_state == STATE_BUY:
+                    if self.get_owned_balance().compare(Decimal(0)) == Decimal(1):
                         logger.info(f"{self} already has a outstanding balance "
-                                    f"of {self.owned_crypto_balance}")
+                                    f"of {self.get_owned_balance()}")
                     else:
                         logger.info(f"{self} is issuing a buy order")
                         buy_order = BuyOrderRequestMessage(self, self.client, self.product_id)
+                        self.order_pending = True
                         self.client.add_message_to_priority_queue(buy_order)
                         self.state = STATE_DEFAULT
                 elif next_state == STATE_SELL:
-                    if self.owned_crypto_balance.compare(Decimal(0)) == Decimal(0):
+                    if self.get_owned_balance().compare(Decimal(0)) == Decimal(0):
                         logger.info(f"{self} does not have any outstanding "
                                     f"crypto to sell")
                     else:
                         logger.info(f"{self} is issuing a sell order")
-                        sell_order = SellOrderRequestMessage(self, self.client, self.product_id)
+                        sell_order = SellOrderRequestMessage(
+                            self,
+                            self.client,
+                            self.product_id,
+                            size=str(self.get_owned_balance()),
+                        )
+                        self.order_pending = True
                         self.client.add_message_to_priority_queue(sell_order)
                         self.state = STATE_DEFAULT
                 else:
@@ -117,22 +287,59 @@ class CryptoMonitor(CryptoWorker):
                         logger.info(f"{self} has just entered state {next_state}")
                     self.state = next_state
             elif isinstance(msg, BuyOrderResponseMessage):
-                self.owned_crypto_balance = Decimal(msg['size'])
+                self.order_pending = False
+                if 'message' in msg.data:
+                    logger.error(f"{self} buy order failed: {msg.data['message']}")
+                else:
+                    self.owned_crypto_balance += Decimal(msg.data['filled_size'])
             elif isinstance(msg, SellOrderResponseMessage):
-                self.owned_crypto_balance = Decimal(0)
+                self.order_pending = False
+                if 'message' in msg.data:
+                    logger.error(f"{self} sell order failed: {msg.data['message']}")
+                else:
+                    self.owned_crypto_balance = max(self.owned_crypto_balance - Decimal(msg.data['filled_size']), Decimal(0))
             else:
                 return
 
-    def process_messages(self):
-        while self.get_remaining_message_count() > 0:
-            msg = self.get_next_message_from_queue()
-            self.process_message(msg)
+    # Seconds until the next request: just after the next candle close, or
+    # sooner while the ticker is polled or no history has arrived yet
+    def get_next_request_delay(self):
+        now = clock.now()
+        delay = next_boundary(now, self.granularity) + CANDLE_CLOSE_DELAY + self.request_offset - now
+        if not self.use_ticker_feed or self.candles is None:
+            delay = min(delay, SLEEP_TIME)
+        return delay
+
+    # Returns the monotonic time of the next request, or None when the
+    # scheduler will send a TimerMessage instead
+    def schedule_request(self):
+        delay = clock.real_seconds(self.get_next_request_delay())
+        if self.scheduler is not None:
+            self.scheduler.schedule(delay, self, TimerMessage(self.scheduler, self))
+            return None
+        return monotonic() + delay
+
+    def stop(self):
+        super().stop()
+        if self.scheduler is not None:
+            self.scheduler.cancel(self)
 
     def run(self):
         logger.info(f"{self} starting")
+        self.warm_start()
+        if self.scheduler is not None:
+            self.request_offset = self.scheduler.register(self)
+        self.request_data()
+        next_request_time = self.schedule_request()
         while not self.is_shutdown():
-            self.request_data()
-            for i in range(int(SLEEP_TIME/SLEEP_INTERVAL)):
-                self.process_messages()
-                sleep(SLEEP_INTERVAL)
+            timeout = None if next_request_time is None else max(next_request_time - monotonic(), 0)
+            msg = self.wait_for_message(timeout)
+            self.process_message(msg)
+            # Market data is spent once processed; everything else may
+            # still be referenced elsewhere
+            if isinstance(msg, (ProductTickerResponseMessage, CandleUpdateMessage)):
+                release_message(msg)
+            if isinstance(msg, TimerMessage) or (next_request_time is not None and monotonic() >= next_request_time):
+                self.request_data()
+                next_request_time = self.schedule_request()
         logger.info(f"{self} terminating")
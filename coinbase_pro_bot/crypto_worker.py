@@ -1,63 +1,72 @@
+import logging
 import threading
+from time import monotonic
+import metrics
 from crypto_logger import logger
+from crypto_mailbox import Mailbox, PRIORITY_LANE, DEFAULT_LANE
 
 
 class CryptoWorker(threading.Thread):
 
     def __init__(self, client):
         super().__init__()
-        self.msg_queue = []
-        self.msg_lock = threading.Lock()
+        self.mailbox = Mailbox()
         self.shutdown = False
         self.client = client
 
+    # Identifies the worker in metrics labels
+    def get_metrics_label(self):
+        return self.__class__.__name__
+
+    def start(self):
+        if metrics.REGISTRY is not None:
+            metrics.REGISTRY.gauge('queue_depth', self.mailbox.__len__, worker=self.get_metrics_label())
+        super().start()
+
     def get_thread_name(self):
         return threading.current_thread().getName()
 
     def get_remaining_message_count(self):
-        self.msg_lock.acquire()
-        count = len(self.msg_queue)
-        self.msg_lock.release()
-        return count
+        return self.mailbox.lane_length(DEFAULT_LANE)
 
     def add_message_to_queue(self, msg):
-        self.msg_lock.acquire()
-        logger.info(msg)
-        self.msg_queue.append(msg)
-        self.msg_lock.release()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(msg)
+        msg.queued_at = monotonic()
+        self.mailbox.put(msg, DEFAULT_LANE)
 
     def get_next_message_from_queue(self):
-        msg = None
-        self.msg_lock.acquire()
-        if len(self.msg_queue) > 0:
-            msg = self.msg_queue.pop(0)
-        self.msg_lock.release()
+        return self.mailbox.get_nowait(DEFAULT_LANE)
+
+    # Blocks until any message is available, the timeout expires or the
+    # worker is stopped. Returns None in the latter two cases.
+    def wait_for_message(self, timeout=None):
+        msg = self.mailbox.get(timeout)
+        registry = metrics.REGISTRY
+        if registry is not None and msg is not None and msg.queued_at is not None:
+            registry.observe('queue_wait_seconds', monotonic() - msg.queued_at, worker=self.get_metrics_label())
         return msg
 
     def is_shutdown(self):
         return self.shutdown
 
+    def stop(self):
+        self.shutdown = True
+        self.mailbox.close()
+        if metrics.REGISTRY is not None:
+            metrics.REGISTRY.remove_gauges(worker=self.get_metrics_label())
+
     def run(self):
         raise NotImplementedError(f"{self.__class__.__name__} does not have an implemented run method")
 
 
 class PriorityCryptoWorker(CryptoWorker):
 
-    def __init__(self, client):
-        super().__init__(client)
-        self.priority_msg_queue = []
-        self.priority_msg_lock = threading.Lock()
-
     def add_message_to_priority_queue(self, msg):
-        self.priority_msg_lock.acquire()
-        logger.info(f"PRIORITY: {msg}")
-        self.priority_msg_queue.append(msg)
-        self.priority_msg_lock.release()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"PRIORITY: {msg}")
+        msg.queued_at = monotonic()
+        self.mailbox.put(msg, PRIORITY_LANE)
 
     def get_next_message_from_priority_queue(self):
-        msg = None
-        self.priority_msg_lock.acquire()
-        if len(self.priority_msg_queue) > 0:
-            msg = self.priority_msg_queue.pop(0)
-        self.priority_msg_lock.release()
-        return msg
+        return self.mailbox.get_nowait(PRIORITY_LANE)
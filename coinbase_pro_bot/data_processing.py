@@ -2,6 +2,8 @@ from decimal import Decimal
 import pandas as pd
 import numpy as np
 from datetime import datetime, timezone
+from time import perf_counter
+import metrics
 from utilities import (
     STATE_DEFAULT,
     STATE_OVERBOUGHT,
@@ -14,6 +16,16 @@ from utilities import (
     RSI_OVERSOLD_THRESHOLD,
 )
 from crypto_logger import logger
+from indicators import (
+    ema,
+    macd,
+    histogram,
+    rsi,
+    RollingRegression,
+    MACD_SLOW_PERIOD,
+    MACD_SIGNAL_PERIOD,
+    RSI_PERIOD,
+)
 
 
 def datetime_from_timestamp(ts_str):
@@ -54,134 +66,106 @@ def check_macd_diff(df):
 
 
 def determine_next_state(df, curr_state):
+    return determine_next_state_from_values(check_rsi(df), check_macd_diff(df), curr_state)
+
+
+def determine_next_state_from_values(rsi_val, macd_diff_val, curr_state,
+                                     oversold=RSI_OVERSOLD_THRESHOLD,
+                                     overbought=RSI_OVERBOUGHT_THRESHOLD):
 
     next_state = curr_state
 
     if curr_state == STATE_DEFAULT:
-        rsi_val = check_rsi(df)
-        if rsi_val >= RSI_OVERBOUGHT_THRESHOLD:
+        if rsi_val >= overbought:
             next_state = STATE_OVERBOUGHT
-        elif rsi_val <= RSI_OVERSOLD_THRESHOLD:
+        elif rsi_val <= oversold:
             next_state = STATE_OVERSOLD
     elif curr_state == STATE_OVERBOUGHT:
-        rsi_val = check_rsi(df)
-        if rsi_val < RSI_OVERBOUGHT_THRESHOLD:
+        if rsi_val < overbought:
             next_state = STATE_SELL_INDICATED
     elif curr_state == STATE_OVERSOLD:
-        rsi_val = check_rsi(df)
-        if rsi_val > RSI_OVERSOLD_THRESHOLD:
+        if rsi_val > oversold:
             next_state = STATE_BUY_INDICATED
     elif curr_state == STATE_SELL_INDICATED:
-        macd_diff_val = check_macd_diff(df)
         if macd_diff_val < 0:
             next_state = STATE_SELL
     elif curr_state == STATE_BUY_INDICATED:
-        macd_diff_val = check_macd_diff(df)
         if macd_diff_val > 0:
             next_state = STATE_BUY
     return next_state
 
 
-
-def calculate_ema(df, period, col_key, out_col_name):
-    ema_name = out_col_name
-    k = Decimal(2)/(Decimal(1) + Decimal(period))
-
-    ema_df = pd.DataFrame([df.timestamp]).transpose()
-    ema_col = [Decimal('nan') for i in range(len(ema_df))]
-    ema_df[ema_name] = ema_col
-
-    ema_df.loc[period-1, (ema_name)] = Decimal(np.mean(df[:period][col_key]))
-
-    for i in range(period, len(ema_df)):
-        ema_df.loc[i, (ema_name)] = Decimal(df.loc[i, col_key])*k + Decimal(ema_df.loc[i-1, ema_name])*(Decimal(1)-k)
-
+# determine_next_state_from_values for arrays of markets at once
+def determine_next_states(rsi_vals, macd_diff_vals, curr_states,
+                          oversold=RSI_OVERSOLD_THRESHOLD,
+                          overbought=RSI_OVERBOUGHT_THRESHOLD):
+    rsi_vals = np.asarray(rsi_vals, dtype=np.float64)
+    macd_diff_vals = np.asarray(macd_diff_vals, dtype=np.float64)
+    curr_states = np.asarray(curr_states)
+    return np.select(
+        [
+            (curr_states == STATE_DEFAULT) & (rsi_vals >= overbought),
+            (curr_states == STATE_DEFAULT) & (rsi_vals <= oversold),
+            (curr_states == STATE_OVERBOUGHT) & (rsi_vals < overbought),
+            (curr_states == STATE_OVERSOLD) & (rsi_vals > oversold),
+            (curr_states == STATE_SELL_INDICATED) & (macd_diff_vals < 0),
+            (curr_states == STATE_BUY_INDICATED) & (macd_diff_vals > 0),
+        ],
+        [STATE_OVERBOUGHT, STATE_OVERSOLD, STATE_SELL_INDICATED, STATE_BUY_INDICATED, STATE_SELL, STATE_BUY],
+        curr_states,
+    )
+
+
+
+def calculate_ema(df, period, col_key, out_col_name, exact=False):
+    ema_df = pd.DataFrame({'timestamp': df.timestamp.to_numpy()})
+    ema_df[out_col_name] = ema(df[col_key].to_numpy(), period, exact=exact)
     return ema_df
 
 
-def calculate_macd(df):
-    ema_12 = calculate_ema(df, 12, 'close', 'ema_12')
-    ema_26 = calculate_ema(df, 26, 'close', 'ema_26')
-
-    macd_df = pd.merge(ema_12, ema_26, on='timestamp')
-    for i in range(len(macd_df)):
-        assert isinstance((macd_df.loc[i, 'ema_12']), type(macd_df.loc[i, 'ema_26']))
-    macd_df['macd'] = macd_df['ema_12']-macd_df['ema_26']
-
-    drop_list = [i for i in range(len(macd_df)) if macd_df.loc[i, 'macd'].is_nan()]
-
-    macd_df.drop(index=drop_list, inplace=True)
-    macd_df.reset_index(drop=True, inplace=True)
-
-    macd_signal_line = calculate_ema(macd_df, 9, 'macd', 'macd_sig')
-
-    macd_df = pd.merge(macd_df, macd_signal_line, on='timestamp')
-
-    macd_df['pos_hist'] = [x if x.compare(Decimal(0)) == Decimal(1) else Decimal(0) for x in macd_df.macd-macd_df.macd_sig]
-    macd_df['neg_hist'] = [x if x.compare(Decimal(0)) == Decimal(-1) else Decimal(0) for x in macd_df.macd-macd_df.macd_sig]
-
-    drop_list = [i for i in range(len(macd_df)) if macd_df.loc[i, 'macd_sig'].is_nan()]
-    macd_df.drop(index=drop_list, inplace=True)
-    macd_df.reset_index(drop=True, inplace=True)
-
-    return macd_df
-
-
-def calculate_rsi(df):
-    period = 14
-    rsi_df = pd.DataFrame([df.timestamp]).transpose()
-    rsi_col = [Decimal('nan') for i in range(len(rsi_df))]
-    close_data = df['close']
-    rsi_df['rsi'] = rsi_col
-    rsi_df['rsi_gains'] = rsi_col
-    rsi_df['rsi_losses'] = rsi_col
+def calculate_macd(df, exact=False):
+    fast, slow, macd_line, signal = macd(df['close'].to_numpy(), exact=exact)
+    pos_hist, neg_hist = histogram(macd_line, signal, exact=exact)
 
-    increase = [0]
-    decrease = [0]
+    macd_df = pd.DataFrame({
+        'timestamp': df.timestamp.to_numpy(),
+        'ema_12': fast,
+        'ema_26': slow,
+        'macd': macd_line,
+        'macd_sig': signal,
+        'pos_hist': pos_hist,
+        'neg_hist': neg_hist,
+    })
 
-    for i in range(len(close_data)-1):
-        change = Decimal(close_data[i+1]-close_data[i])
-        if change >= 0:
-            increase.append(change)
-            decrease.append(Decimal(0))
-        else:
-            increase.append(Decimal(0))
-            decrease.append(-change)
+    return macd_df.iloc[MACD_SLOW_PERIOD + MACD_SIGNAL_PERIOD - 2:].reset_index(drop=True)
 
-    rsi_df.loc[period-1, 'rsi_gains'] = Decimal(np.mean([x for x in increase[:period]]))
-    rsi_df.loc[period-1, 'rsi_losses'] = Decimal(np.mean([x for x in decrease[:period]]))
 
-    for i in range(period, len(rsi_df)):
-        rsi_df.loc[i, 'rsi_gains'] = (rsi_df.loc[i-1, 'rsi_gains']*(period-1)+increase[i])/period
-        rsi_df.loc[i, 'rsi_losses'] = (rsi_df.loc[i-1, 'rsi_losses']*(period-1)+decrease[i])/period
+def calculate_rsi(df, exact=False):
+    rsi_line, gains, losses = rsi(df['close'].to_numpy(), RSI_PERIOD, exact=exact)
 
-    for i in range(len(rsi_df)):
-        if rsi_df.loc[i, 'rsi_losses'] == Decimal(0):
-            rsi_df.loc[i, 'rsi'] = Decimal(100)
-        else:
-            rsi_df.loc[i, 'rsi'] = Decimal(100 - (100/(1+(rsi_df.loc[i, 'rsi_gains']/rsi_df.loc[i, 'rsi_losses']))))
+    rsi_df = pd.DataFrame({
+        'timestamp': df.timestamp.to_numpy(),
+        'rsi': rsi_line,
+        'rsi_gains': gains,
+        'rsi_losses': losses,
+    })
 
-    drop_list = [i for i in range(len(rsi_df)) if rsi_df.loc[i, 'rsi'].is_nan()]
-    rsi_df.drop(index=drop_list, inplace=True)
-    rsi_df.reset_index(drop=True, inplace=True)
+    return rsi_df.iloc[RSI_PERIOD-1:].reset_index(drop=True)
 
-    return rsi_df
 
+def gather_all_crypto_data(df, exact=False, product_id=None):
 
-def gather_all_crypto_data(df):
+    started = perf_counter() if metrics.REGISTRY is not None else None
 
-    macd_df = calculate_macd(df)
+    macd_df = calculate_macd(df, exact=exact)
 
-    rsi_df = calculate_rsi(df)
+    rsi_df = calculate_rsi(df, exact=exact)
 
     df = pd.merge(df, macd_df, on='timestamp')
     df = pd.merge(df, rsi_df, on='timestamp')
 
-    macd_drop_list = [i for i in range(len(df)) if df.loc[i, 'macd'].is_nan()]
-    rsi_drop_list = [i for i in range(len(df)) if df.loc[i, 'rsi'].is_nan()]
-    df.drop(index=macd_drop_list, inplace=True)
-    df.drop(index=rsi_drop_list, inplace=True)
-    df.reset_index(drop=True, inplace=True)
+    if started is not None:
+        metrics.REGISTRY.observe('gather_all_crypto_data_seconds', perf_counter() - started, market=product_id or 'unknown')
 
     return df
 
@@ -189,8 +173,7 @@ def gather_all_crypto_data(df):
 def save_graphs(df):
     import matplotlib.pyplot as plt
 
-    z = np.polyfit(df.index, [float(x) for x in df.close], 1)
-    p = np.poly1d(z)
+    p = np.poly1d(RollingRegression.from_values(df.close.to_numpy(), (len(df),)).line())
 
     fig, ax = plt.subplots(nrows=3, sharex=True)
     ax[0].xaxis_date()
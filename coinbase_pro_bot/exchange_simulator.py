@@ -0,0 +1,299 @@
+import threading
+import uuid
+from datetime import datetime
+from decimal import Decimal
+from time import sleep, monotonic
+
+import numpy as np
+
+import clock
+from rate_limiter import TokenBucket, DEFAULT_RATE_LIMITS, PUBLIC_ENDPOINT, PRIVATE_ENDPOINT, market_rate_limits
+from utilities import FIAT_MARKETS, MAX_CANDLES_PER_REQUEST, GRANULARITIES, isoformat
+
+# Resolution of the simulated price paths, in seconds of market time
+BASE_GRANULARITY = 60
+# Minutes generated at a time when a synthetic path has to be extended
+PATH_CHUNK = 1440
+# Round trip latency in market seconds, drawn from a normal distribution
+LATENCY = 0.08
+LATENCY_JITTER = 0.03
+TAKER_FEE = Decimal('0.005')
+SPREAD = 0.0005
+STARTING_BALANCE = Decimal(1000)
+
+
+def error(message):
+    return {'message': message}
+
+
+# Prices of one product every BASE_GRANULARITY seconds from origin, either
+# replayed from stored candles or a random walk extended on demand
+class PricePath(object):
+
+    def __init__(self, origin, prices, seed=None, volatility=0.002):
+        self.origin = origin
+        self.prices = prices
+        self.rng = None if seed is None else np.random.default_rng(seed)
+        self.volatility = volatility
+
+    @classmethod
+    def synthetic(cls, origin, seed, price=100.0, volatility=0.002):
+        return cls(origin, np.array([price]), seed, volatility)
+
+    # Replays a CandleSeries at its own granularity, stretched to the base
+    # resolution by holding each close
+    @classmethod
+    def replay(cls, candles):
+        granularity = int(candles.timestamp[1] - candles.timestamp[0])
+        return cls(int(candles.timestamp[0]), np.repeat(candles.close, max(granularity//BASE_GRANULARITY, 1)))
+
+    def extend_to(self, index):
+        if index < len(self.prices) or self.rng is None:
+            return
+        count = ((index - len(self.prices))//PATH_CHUNK + 1)*PATH_CHUNK
+        steps = np.exp(np.cumsum(self.rng.normal(0, self.volatility, count)))
+        self.prices = np.concatenate((self.prices, self.prices[-1]*steps))
+
+    # Prices for [start, end] in market time, clipped to what the path covers
+    def window(self, start, end):
+        first = max((start - self.origin)//BASE_GRANULARITY, 0)
+        last = (end - self.origin)//BASE_GRANULARITY
+        self.extend_to(last)
+        return self.prices[first:min(last, len(self.prices) - 1) + 1]
+
+    def price(self, timestamp):
+        index = (int(timestamp) - self.origin)//BASE_GRANULARITY
+        self.extend_to(index)
+        return float(self.prices[min(max(index, 0), len(self.prices) - 1)])
+
+
+# In-process stand-in for the Coinbase Pro REST API. Market data, latency and
+# rate limits all follow the installed clock, so with a SimulatedClock the
+# bot sees hours of candles go by in minutes with the same request budget
+# per candle as against the real exchange. Orders fill at the simulated price with the spread
+# and taker fee applied, and are reported done fill_delay real seconds later.
+class ExchangeSimulator(object):
+
+    # Synthetic paths start far enough back to serve a full window of
+    # history at the largest of `granularities`
+    def __init__(self, products=None, paths=None, granularities=(3600,), balance=STARTING_BALANCE, seed=0,
+                 latency=LATENCY, latency_jitter=LATENCY_JITTER, rate_limits=DEFAULT_RATE_LIMITS,
+                 fill_delay=0):
+        if products is None:
+            products = [f"{crypto}-USD" for crypto in FIAT_MARKETS]
+        origin = int(clock.now()) - MAX_CANDLES_PER_REQUEST*max(granularities)
+        self.paths = paths or {}
+        for i, product_id in enumerate(products):
+            if product_id not in self.paths:
+                self.paths[product_id] = PricePath.synthetic(origin, seed + i)
+        self.rng = np.random.default_rng(seed)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.buckets = {name: TokenBucket(rate, burst) for name, (rate, burst) in market_rate_limits(rate_limits).items()}
+        self.balances = {'USD': Decimal(balance)}
+        for product_id in self.paths:
+            self.balances[product_id.split('-')[0]] = Decimal(0)
+        self.orders = {}
+        self.fill_delay = fill_delay
+        self.fill_times = {}
+        self.requests = 0
+        self.rate_limited = 0
+        self.lock = threading.Lock()
+
+    def create_client(self):
+        return SimulatedClient(self)
+
+    # Sleeps for one round trip and returns an error response if the
+    # endpoint's rate limit is used up
+    def call(self, endpoint):
+        with self.lock:
+            self.requests += 1
+            delay = max(self.rng.normal(self.latency, self.latency_jitter), 0)
+        sleep(clock.real_seconds(delay))
+        if self.buckets[endpoint].try_acquire() > 0:
+            with self.lock:
+                self.rate_limited += 1
+            return error('Rate limit exceeded')
+        return None
+
+    def historic_rates(self, product_id, start=None, end=None, granularity=None):
+        granularity = int(granularity or 60)
+        if granularity not in GRANULARITIES:
+            return error('Unsupported granularity')
+        if product_id not in self.paths:
+            return error('NotFound')
+        now = int(clock.now())
+        end = now if end is None else min(int(datetime.fromisoformat(end).timestamp()), now)
+        if start is None:
+            start = end - (MAX_CANDLES_PER_REQUEST - 1)*granularity
+        else:
+            start = int(datetime.fromisoformat(start).timestamp())
+        start -= start % granularity
+        if (end - start)//granularity >= MAX_CANDLES_PER_REQUEST:
+            return error('granularity too small for the requested time range')
+        path = self.paths[product_id]
+        step = granularity//BASE_GRANULARITY
+        with self.lock:
+            prices = path.window(start, end)
+        first = max((start - path.origin)//BASE_GRANULARITY, 0)
+        candles = []
+        for bucket in range(start, end + 1, granularity):
+            offset = (bucket - path.origin)//BASE_GRANULARITY - first
+            if offset < 0:
+                continue
+            # The newest candle is still open and only covers up to now
+            close = min(offset + step, (now - path.origin)//BASE_GRANULARITY - first + 1)
+            values = prices[offset:close]
+            if len(values) == 0:
+                break
+            volume = float(np.sum(np.abs(np.diff(values)))*1000 + len(values))
+            candles.append([bucket, float(values.min()), float(values.max()), float(values[0]), float(values[-1]), volume])
+        candles.reverse()
+        return candles
+
+    def ticker(self, product_id):
+        if product_id not in self.paths:
+            return error('NotFound')
+        now = clock.now()
+        with self.lock:
+            price = self.paths[product_id].price(now)
+        return {
+            'trade_id': int(now),
+            'price': f"{price:.2f}",
+            'size': '0.01',
+            'bid': f"{price*(1 - SPREAD):.2f}",
+            'ask': f"{price*(1 + SPREAD):.2f}",
+            'volume': '1000',
+            'time': isoformat(now),
+        }
+
+    def accounts(self):
+        with self.lock:
+            return [{
+                'id': currency,
+                'currency': currency,
+                'balance': str(balance),
+                'available': str(balance),
+                'hold': '0',
+                'profile_id': 'simulator',
+                'trading_enabled': True,
+            } for currency, balance in self.balances.items()]
+
+    def market_order(self, product_id, side, size=None, funds=None):
+        if product_id not in self.paths:
+            return error('NotFound')
+        if side not in ('buy', 'sell') or (size is None) == (funds is None):
+            return error('Invalid order')
+        crypto, fiat = product_id.split('-')
+        now = clock.now()
+        with self.lock:
+            price = self.paths[product_id].price(now)
+            price = Decimal(f"{price*(1 + SPREAD if side == 'buy' else 1 - SPREAD):.2f}")
+            if funds is not None:
+                executed_value = Decimal(str(funds))/(1 + TAKER_FEE)
+                filled_size = (executed_value/price).quantize(Decimal('0.00000001'))
+            else:
+                filled_size = Decimal(str(size))
+            executed_value = filled_size*price
+            fees = executed_value*TAKER_FEE
+            if side == 'buy':
+                if self.balances[fiat] < executed_value + fees:
+                    return error('Insufficient funds')
+                self.balances[fiat] -= executed_value + fees
+                self.balances[crypto] += filled_size
+            else:
+                if self.balances[crypto] < filled_size:
+                    return error('Insufficient funds')
+                self.balances[crypto] -= filled_size
+                self.balances[fiat] += executed_value - fees
+            order = {
+                'id': str(uuid.uuid4()),
+                'product_id': product_id,
+                'side': side,
+                'type': 'market',
+                'post_only': False,
+                'created_at': isoformat(now),
+                'done_at': isoformat(now),
+                'done_reason': 'filled',
+                'fill_fees': str(fees),
+                'filled_size': str(filled_size),
+                'executed_value': str(executed_value),
+                'status': 'done',
+                'settled': True,
+            }
+            if funds is not None:
+                order['funds'] = str(funds)
+            else:
+                order['size'] = str(size)
+            self.orders[order['id']] = order
+            self.fill_times[order['id']] = monotonic() + self.fill_delay
+        return self.order(order['id'])
+
+    # The order as the exchange would report it now, pending until its fill
+    # time has passed
+    def order(self, order_id):
+        with self.lock:
+            if order_id not in self.orders:
+                return error('NotFound')
+            order = dict(self.orders[order_id])
+            if monotonic() < self.fill_times[order_id]:
+                order.update(status='pending', settled=False, filled_size='0', executed_value='0', fill_fees='0')
+                del order['done_at']
+                del order['done_reason']
+        return order
+
+
+# The per connection object handed to the ApiRequestManager's client pool,
+# with the same method signatures as cbpro.AuthenticatedClient
+class SimulatedClient(object):
+
+    def __init__(self, exchange):
+        self.exchange = exchange
+
+    def get_product_historic_rates(self, product_id, start=None, end=None, granularity=None):
+        return self.exchange.call(PUBLIC_ENDPOINT) or \
+            self.exchange.historic_rates(product_id, start, end, granularity)
+
+    def get_product_ticker(self, product_id):
+        return self.exchange.call(PUBLIC_ENDPOINT) or self.exchange.ticker(product_id)
+
+    def get_accounts(self):
+        return self.exchange.call(PRIVATE_ENDPOINT) or self.exchange.accounts()
+
+    def place_market_order(self, product_id, side, size=None, funds=None, client_oid=None, stp=None,
+                           overdraft_enabled=None, funding_amount=None):
+        return self.exchange.call(PRIVATE_ENDPOINT) or \
+            self.exchange.market_order(product_id, side, size, funds)
+
+    def get_order(self, order_id):
+        return self.exchange.call(PRIVATE_ENDPOINT) or self.exchange.order(order_id)
+
+
+# Runs the whole PortfolioManager against the simulator at `speed` times
+# real time for `duration` real seconds. The default one minute candles give
+# the monitors enough closes within a short run to trade.
+def run_simulation(speed=100, duration=60, request_concurrency=4, granularities=(60,), **kwargs):
+    from portfolio_manager import PortfolioManager
+
+    clock.install(clock.SimulatedClock(speed))
+    exchange = ExchangeSimulator(granularities=granularities, **kwargs)
+    pm = PortfolioManager(None, request_concurrency, granularities=granularities,
+                          client_factory=exchange.create_client)
+    pm.start()
+    sleep(duration)
+    for monitor in pm.historical_data_monitors:
+        monitor.stop()
+        monitor.join()
+    pm.stop()
+    pm.join()
+    pm.scheduler.stop()
+    pm.client.stop()
+    pm.client.join()
+    clock.uninstall()
+    return exchange
+
+
+if __name__ == "__main__":
+    exchange = run_simulation()
+    print(f"{exchange.requests} requests, {exchange.rate_limited} rate limited, {len(exchange.orders)} orders")
+    print(exchange.accounts())
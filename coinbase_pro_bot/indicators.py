@@ -0,0 +1,342 @@
+from collections import namedtuple
+from decimal import Decimal
+import numpy as np
+import pandas as pd
+
+MACD_FAST_PERIOD = 12
+MACD_SLOW_PERIOD = 26
+MACD_SIGNAL_PERIOD = 9
+RSI_PERIOD = 14
+
+
+# First index at which MACD, its signal line and RSI are all defined
+def indicator_warmup(fast_period=MACD_FAST_PERIOD, slow_period=MACD_SLOW_PERIOD,
+                     signal_period=MACD_SIGNAL_PERIOD, rsi_period=RSI_PERIOD):
+    return max(max(fast_period, slow_period) + signal_period - 2, rsi_period - 1)
+
+
+DECIMAL_NAN = Decimal('nan')
+
+
+def to_float_array(values):
+    return np.asarray(values).astype(np.float64, copy=False)
+
+
+def to_decimal_list(values):
+    return [x if isinstance(x, Decimal) else Decimal(str(x)) for x in values]
+
+
+# Exponential moving average seeded with the simple mean of the first
+# `period` values. Entries before the seed are nan. The float functions below
+# work along the last axis, so a (markets x time) matrix of aligned series is
+# evaluated in one call.
+def seeded_ewm(values, period, alpha):
+    values = to_float_array(values)
+    out = np.full(values.shape, np.nan)
+    if values.shape[-1] < period:
+        return out
+    if values.ndim == 1:
+        seeded = np.concatenate(([values[:period].mean()], values[period:]))
+        out[period-1:] = pd.Series(seeded).ewm(alpha=alpha, adjust=False).mean().to_numpy()
+        return out
+    # pandas applies ewm column by column, stepping every row at once along
+    # time is much cheaper for many short series
+    steps = np.moveaxis(values, -1, 0).copy()
+    result = np.moveaxis(out, -1, 0).copy()
+    result[period-1] = steps[:period].mean(axis=0)
+    steps *= alpha
+    for i in range(period, len(steps)):
+        np.multiply(result[i-1], 1 - alpha, out=result[i])
+        result[i] += steps[i]
+    return np.moveaxis(result, 0, -1)
+
+
+def seeded_ewm_exact(values, period, alpha):
+    values = to_decimal_list(values)
+    out = [DECIMAL_NAN for _ in range(len(values))]
+    if len(values) < period:
+        return out
+    out[period-1] = sum(values[:period]) / period
+    for i in range(period, len(values)):
+        out[i] = values[i]*alpha + out[i-1]*(Decimal(1)-alpha)
+    return out
+
+
+def ema(values, period, exact=False):
+    if exact:
+        return seeded_ewm_exact(values, period, Decimal(2)/(Decimal(1) + Decimal(period)))
+    return seeded_ewm(values, period, 2/(1 + period))
+
+
+# Returns (fast_ema, slow_ema, macd, signal) aligned with `values`. macd is nan
+# until the slow EMA is seeded, signal is nan until it has seen `signal_period`
+# macd values.
+def macd(values, fast_period=MACD_FAST_PERIOD, slow_period=MACD_SLOW_PERIOD,
+         signal_period=MACD_SIGNAL_PERIOD, exact=False):
+    fast = ema(values, fast_period, exact=exact)
+    slow = ema(values, slow_period, exact=exact)
+    start = max(fast_period, slow_period) - 1
+    if exact:
+        macd_line = [f - s for f, s in zip(fast, slow)]
+        signal = [DECIMAL_NAN for _ in range(start)] + ema(macd_line[start:], signal_period, exact=True)
+    else:
+        macd_line = fast - slow
+        signal = np.full(macd_line.shape, np.nan)
+        signal[..., start:] = ema(macd_line[..., start:], signal_period)
+    return fast, slow, macd_line, signal
+
+
+def histogram(macd_line, signal, exact=False):
+    if exact:
+        diff = [m - s for m, s in zip(macd_line, signal)]
+        pos = [x if x.compare(Decimal(0)) == Decimal(1) else Decimal(0) for x in diff]
+        neg = [x if x.compare(Decimal(0)) == Decimal(-1) else Decimal(0) for x in diff]
+        return pos, neg
+    diff = macd_line - signal
+    return np.where(diff > 0, diff, 0.0), np.where(diff < 0, diff, 0.0)
+
+
+# Wilder RSI. Returns (rsi, avg_gains, avg_losses) aligned with `values`;
+# the first change is taken as zero so the seed covers values[:period].
+def rsi(values, period=RSI_PERIOD, exact=False):
+    if exact:
+        return rsi_exact(values, period)
+    values = to_float_array(values)
+    change = np.diff(values, prepend=values[..., :1])
+    gains = seeded_ewm(np.maximum(change, 0.0), period, 1/period)
+    losses = seeded_ewm(np.maximum(-change, 0.0), period, 1/period)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rsi_line = 100 - 100/(1 + gains/losses)
+    rsi_line[losses == 0] = 100.0
+    return rsi_line, gains, losses
+
+
+def rsi_exact(values, period=RSI_PERIOD):
+    values = to_decimal_list(values)
+    change = [Decimal(0)] + [values[i+1]-values[i] for i in range(len(values)-1)]
+    increase = [x if x >= 0 else Decimal(0) for x in change]
+    decrease = [-x if x < 0 else Decimal(0) for x in change]
+    gains = [DECIMAL_NAN for _ in range(len(values))]
+    losses = [DECIMAL_NAN for _ in range(len(values))]
+    if len(values) >= period:
+        gains[period-1] = sum(increase[:period]) / period
+        losses[period-1] = sum(decrease[:period]) / period
+        for i in range(period, len(values)):
+            gains[i] = (gains[i-1]*(period-1)+increase[i])/period
+            losses[i] = (losses[i-1]*(period-1)+decrease[i])/period
+    rsi_line = []
+    for g, l in zip(gains, losses):
+        if l.is_nan():
+            rsi_line.append(DECIMAL_NAN)
+        elif l == 0:
+            rsi_line.append(Decimal(100))
+        else:
+            rsi_line.append(100 - (100/(1+(g/l))))
+    return rsi_line, gains, losses
+
+
+# Least squares slope of values against their index along the last axis, the
+# same value np.polyfit(range(n), row, 1)[0] gives for each row
+def linear_slope(values):
+    values = to_float_array(values)
+    x = np.arange(values.shape[-1], dtype=np.float64)
+    x -= x.mean()
+    return (values @ x)/(x @ x)
+
+
+# Least squares slope of each trailing `window` values against their index,
+# the same value np.polyfit(range(window), values[i-window+1:i+1], 1)[0] gives
+def rolling_slope(values, window):
+    values = to_float_array(values)
+    out = np.full(len(values), np.nan)
+    if len(values) < window:
+        return out
+    # The slope doesn't change under a constant shift, and centring keeps the
+    # running sums small enough to stay precise over millions of values
+    values = values - values.mean()
+    index = np.arange(len(values), dtype=np.float64)
+    sum_y = np.concatenate(([0.0], np.cumsum(values)))
+    sum_iy = np.concatenate(([0.0], np.cumsum(index*values)))
+    window_y = sum_y[window:] - sum_y[:-window]
+    start = index[:len(values)-window+1]
+    # Shift the index so x runs 0..window-1 inside every window
+    window_xy = (sum_iy[window:] - sum_iy[:-window]) - start*window_y
+    sum_x = window*(window-1)/2
+    sum_xx = (window-1)*window*(2*window-1)/6
+    out[window-1:] = (window*window_xy - sum_x*window_y)/(window*sum_xx - sum_x**2)
+    return out
+
+
+def rsi_from_averages(avg_gain, avg_loss):
+    if np.isnan(avg_loss):
+        return np.nan
+    if avg_loss == 0:
+        return 100.0
+    return 100 - 100/(1 + avg_gain/avg_loss)
+
+
+IndicatorSnapshot = namedtuple('IndicatorSnapshot', ['fast_ema', 'slow_ema', 'macd', 'macd_sig', 'rsi'])
+
+
+# Streaming counterpart of seeded_ewm. peek() returns the value the next
+# input would produce without changing any state, commit() applies it.
+class IncrementalEma(object):
+
+    def __init__(self, period, alpha=None):
+        self.period = period
+        self.alpha = 2/(1 + period) if alpha is None else alpha
+        self.count = 0
+        self.total = 0.0
+        self.value = np.nan
+
+    def peek(self, x):
+        if self.count >= self.period:
+            return x*self.alpha + self.value*(1-self.alpha)
+        if self.count == self.period-1:
+            return (self.total + x)/self.period
+        return np.nan
+
+    def commit(self, x):
+        self.value = self.peek(x)
+        if self.count < self.period:
+            self.total += x
+        self.count += 1
+        return self.value
+
+
+# Keeps the EMA, MACD signal and Wilder gain/loss accumulators for a single
+# close series so a provisional tick costs O(1) instead of a full recompute.
+class IncrementalIndicators(object):
+
+    def __init__(self, fast_period=MACD_FAST_PERIOD, slow_period=MACD_SLOW_PERIOD,
+                 signal_period=MACD_SIGNAL_PERIOD, rsi_period=RSI_PERIOD):
+        self.fast = IncrementalEma(fast_period)
+        self.slow = IncrementalEma(slow_period)
+        self.signal = IncrementalEma(signal_period)
+        self.gains = IncrementalEma(rsi_period, 1/rsi_period)
+        self.losses = IncrementalEma(rsi_period, 1/rsi_period)
+        self.last_close = None
+        self.count = 0
+        self.last = IndicatorSnapshot(np.nan, np.nan, np.nan, np.nan, np.nan)
+
+    @classmethod
+    def from_parameters(cls, parameters):
+        return cls(parameters.macd_fast, parameters.macd_slow, parameters.macd_signal, parameters.rsi_period)
+
+    @classmethod
+    def from_closes(cls, closes, parameters=None):
+        indicators = cls() if parameters is None else cls.from_parameters(parameters)
+        for close in to_float_array(closes):
+            indicators.commit(close)
+        return indicators
+
+    def step(self, close, commit):
+        update = 'commit' if commit else 'peek'
+        close = float(close)
+        change = 0.0 if self.last_close is None else close - self.last_close
+
+        fast = getattr(self.fast, update)(close)
+        slow = getattr(self.slow, update)(close)
+        macd_val = fast - slow
+        signal = np.nan if np.isnan(macd_val) else getattr(self.signal, update)(macd_val)
+        avg_gain = getattr(self.gains, update)(max(change, 0.0))
+        avg_loss = getattr(self.losses, update)(max(-change, 0.0))
+
+        snapshot = IndicatorSnapshot(fast, slow, macd_val, signal, rsi_from_averages(avg_gain, avg_loss))
+        if commit:
+            self.last_close = close
+            self.count += 1
+            self.last = snapshot
+        return snapshot
+
+    def peek(self, close):
+        return self.step(close, False)
+
+    def commit(self, close):
+        return self.step(close, True)
+
+    def is_ready(self):
+        return not np.isnan(self.last.macd_sig) and not np.isnan(self.last.rsi)
+
+
+def regression_slope(n, sum_y, sum_xy):
+    if n < 2:
+        return np.nan
+    sum_x = n*(n-1)/2
+    sum_xx = (n-1)*n*(2*n-1)/6
+    return (n*sum_xy - sum_x*sum_y)/(n*sum_xx - sum_x**2)
+
+
+# Least squares line through the last `window` committed values against
+# their index, for one or more windows, kept as running sums so commit() and
+# peek() are O(1) instead of an np.polyfit over the whole window. Values are
+# stored relative to an offset and the sums are rebuilt from the stored
+# values once per full turn of the buffer, so rounding cannot accumulate.
+class RollingRegression(object):
+
+    def __init__(self, windows):
+        self.windows = tuple(windows)
+        self.capacity = max(self.windows)
+        self.values = np.zeros(self.capacity)
+        self.count = 0
+        self.offset = None
+        self.sum_y = dict.fromkeys(self.windows, 0.0)
+        self.sum_xy = dict.fromkeys(self.windows, 0.0)
+
+    @classmethod
+    def from_values(cls, values, windows):
+        regression = cls(windows)
+        for value in to_float_array(values):
+            regression.commit(value)
+        return regression
+
+    def size(self, window):
+        return min(self.count, window)
+
+    def commit(self, value):
+        value = float(value)
+        if self.offset is None:
+            self.offset = value
+        y = value - self.offset
+        for window in self.windows:
+            n = self.size(window)
+            if n == window:
+                # Drop the oldest value, every other x moves down by one
+                oldest = self.values[(self.count - window) % self.capacity]
+                self.sum_xy[window] -= self.sum_y[window] - oldest
+                self.sum_y[window] -= oldest
+                n -= 1
+            self.sum_xy[window] += n*y
+            self.sum_y[window] += y
+        self.values[self.count % self.capacity] = y
+        self.count += 1
+        if self.count % self.capacity == 0:
+            self.resync()
+
+    def resync(self):
+        shift = self.values.mean()
+        self.values -= shift
+        self.offset += shift
+        for window in self.windows:
+            recent = self.values[-window:] if window < self.capacity else self.values
+            self.sum_y[window] = float(recent.sum())
+            self.sum_xy[window] = float(recent @ np.arange(window, dtype=np.float64))
+
+    def slope(self, window=None):
+        window = self.windows[0] if window is None else window
+        return regression_slope(self.size(window), self.sum_y[window], self.sum_xy[window])
+
+    # Slope of the window with `value` appended as a provisional newest
+    # point, without changing any state
+    def peek(self, value, window=None):
+        window = self.windows[0] if window is None else window
+        n = self.size(window)
+        y = float(value) - (float(value) if self.offset is None else self.offset)
+        return regression_slope(n + 1, self.sum_y[window] + y, self.sum_xy[window] + n*y)
+
+    # (slope, intercept) of the line over the window, x running from 0
+    def line(self, window=None):
+        window = self.windows[0] if window is None else window
+        n = self.size(window)
+        slope = self.slope(window)
+        return slope, self.sum_y[window]/n - slope*(n-1)/2 + self.offset
@@ -0,0 +1,133 @@
+import threading
+from collections import namedtuple
+from decimal import Decimal
+from types import MappingProxyType
+
+import clock
+from crypto_logger import logger
+
+# Seconds of market time between get_accounts reconciliations
+RECONCILE_INTERVAL = 15*60
+
+FILL = 'fill'
+RECONCILE = 'reconcile'
+
+# kind is FILL or RECONCILE, changes maps currency to the balance delta and
+# position, for fills, is (product_id, crypto delta)
+LedgerEvent = namedtuple('LedgerEvent', ['version', 'kind', 'time', 'changes', 'detail', 'position'])
+
+
+# Immutable view of the balances after `version` events. Readers keep
+# whichever snapshot they fetched for as long as they like.
+class LedgerSnapshot(object):
+
+    __slots__ = ['version', 'balances', 'positions', 'fills']
+
+    def __init__(self, version, balances, positions, fills):
+        self.version = version
+        self.balances = MappingProxyType(balances)
+        self.positions = MappingProxyType(positions)
+        self.fills = fills
+
+    def balance(self, currency):
+        return self.balances.get(currency, Decimal(0))
+
+    # Crypto the bot bought for a product such as 'BTC-USD' and still holds.
+    # Built from fills only, so holdings the bot never bought are not its to
+    # sell, and capped by the account balance in case some of it left the
+    # account.
+    def position(self, product_id):
+        return max(min(self.positions.get(product_id, Decimal(0)), self.balance(product_id.split('-')[0])), Decimal(0))
+
+
+def fill_position(order):
+    size = Decimal(order['filled_size'])
+    return order['product_id'], size if order['side'] == 'buy' else -size
+
+
+def fill_changes(order):
+    crypto, fiat = order['product_id'].split('-')
+    size = Decimal(order['filled_size'])
+    value = Decimal(order['executed_value'])
+    fees = Decimal(order.get('fill_fees', '0'))
+    if order['side'] == 'buy':
+        return {crypto: size, fiat: -(value + fees)}
+    return {crypto: -size, fiat: value - fees}
+
+
+# Account balances kept as a log of events: order fills as they happen, and
+# now and then a reconciliation that snaps the balances to get_accounts.
+# Positions only ever move with fills; reconciliation just reports drift.
+# Writers are serialized by a lock; every write publishes a new
+# LedgerSnapshot by swapping one reference, so readers never lock.
+class Ledger(object):
+
+    def __init__(self, balances=None):
+        self.events = []
+        self.lock = threading.Lock()
+        self.current = LedgerSnapshot(0, dict(balances or {}), {}, 0)
+
+    def __str__(self):
+        return f"Ledger(v{self.current.version})"
+
+    def snapshot(self):
+        return self.current
+
+    # Called with the lock held
+    def append(self, kind, changes, detail=None, position=None):
+        current = self.current
+        balances = dict(current.balances)
+        for currency, change in changes.items():
+            balances[currency] = balances.get(currency, Decimal(0)) + change
+        positions = dict(current.positions)
+        if position is not None:
+            product_id, change = position
+            positions[product_id] = max(positions.get(product_id, Decimal(0)) + change, Decimal(0))
+        event = LedgerEvent(current.version + 1, kind, clock.now(), changes, detail, position)
+        self.events.append(event)
+        self.current = LedgerSnapshot(event.version, balances, positions, current.fills + (kind == FILL))
+        return event
+
+    def apply_fill(self, order):
+        with self.lock:
+            return self.append(FILL, fill_changes(order), order['id'], fill_position(order))
+
+    # Currencies whose account balance no longer covers what the bot's fills
+    # say it holds, {currency: (held by fills, balance)}
+    def shortfalls(self, snapshot=None):
+        snapshot = snapshot or self.current
+        held = {}
+        for product_id, size in snapshot.positions.items():
+            crypto = product_id.split('-')[0]
+            held[crypto] = held.get(crypto, Decimal(0)) + size
+        return {currency: (size, snapshot.balance(currency))
+                for currency, size in held.items() if snapshot.balance(currency) < size}
+
+    # Snaps the balances to a get_accounts response. Skipped, returning
+    # None, if a fill was applied after `fills` (the snapshot's fill count
+    # when the accounts were requested), since the response may or may not
+    # include it.
+    def reconcile(self, accounts, fills=None):
+        reported = {account['currency']: Decimal(account['balance']) for account in accounts}
+        with self.lock:
+            current = self.current
+            if fills is not None and fills != current.fills:
+                return None
+            changes = {}
+            for currency in set(reported) | set(current.balances):
+                change = reported.get(currency, Decimal(0)) - current.balance(currency)
+                if change != 0:
+                    changes[currency] = change
+            event = self.append(RECONCILE, changes)
+        if len(changes) > 0 and current.version > 0:
+            logger.warning(f"{self} reconciled drift {changes}")
+        for currency, (held, balance) in self.shortfalls().items():
+            logger.warning(f"{self} holds {balance} {currency}, less than the {held} its fills bought")
+        return event
+
+    @classmethod
+    def replay(cls, events):
+        ledger = cls()
+        for event in events:
+            ledger.append(event.kind, event.changes, event.detail, event.position)
+        return ledger
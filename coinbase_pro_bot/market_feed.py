@@ -0,0 +1,107 @@
+import json
+from time import sleep
+from websocket import create_connection, WebSocketException
+
+from candle_builder import CandleBuilder
+from crypto_worker import CryptoWorker
+from crypto_message import ProductTickerResponseMessage, MarketDataGapMessage
+from crypto_logger import logger
+
+FEED_URL = 'wss://ws-feed.pro.coinbase.com'
+FEED_CHANNELS = ['ticker']
+RECV_TIMEOUT = 30
+INITIAL_RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 30
+
+PRICE_MESSAGE_TYPES = ('ticker', 'match', 'last_match')
+
+
+# Single websocket subscription shared by every monitored product. Price
+# updates are forwarded to each registered monitor as the same
+# ProductTickerResponseMessage the REST ticker produces.
+class MarketDataFeed(CryptoWorker):
+
+    def __init__(self, url=FEED_URL, channels=FEED_CHANNELS):
+        super().__init__(None)
+        self.url = url
+        self.channels = channels
+        self.subscribers = {}
+        self.ws = None
+        self.connections = 0
+
+    def __str__(self):
+        return f"MarketDataFeed({self.url})"
+
+    def register(self, product_id, worker):
+        self.subscribers.setdefault(product_id, []).append(worker)
+
+    def get_product_ids(self):
+        return list(self.subscribers)
+
+    def connect(self):
+        self.ws = create_connection(self.url, timeout=RECV_TIMEOUT)
+        self.ws.send(json.dumps({
+            'type': 'subscribe',
+            'product_ids': self.get_product_ids(),
+            'channels': self.channels,
+        }))
+        logger.info(f"{self} subscribed to {len(self.subscribers)} products")
+        self.connections += 1
+        if self.connections > 1:
+            self.notify_gap()
+
+    # Anything traded while disconnected was missed, so subscribers have to
+    # backfill it from REST. A CandleBuilder passes the gap on to its own
+    # subscribers, so those are skipped here to tell each worker only once.
+    def notify_gap(self):
+        for product_id, workers in self.subscribers.items():
+            told = {subscriber for worker in workers if isinstance(worker, CandleBuilder)
+                    for subscriber in worker.all_subscribers()}
+            for worker in workers:
+                if worker not in told:
+                    worker.add_message_to_queue(MarketDataGapMessage(self, worker, product_id))
+
+    def dispatch(self, data):
+        if data.get('type') not in PRICE_MESSAGE_TYPES or 'price' not in data:
+            if data.get('type') == 'error':
+                logger.warning(f"{self} received error: {data.get('message')}")
+            return
+        for worker in self.subscribers.get(data.get('product_id'), []):
+            worker.add_message_to_queue(ProductTickerResponseMessage.from_data(self, worker, data))
+
+    def receive_messages(self):
+        while not self.is_shutdown():
+            raw = self.ws.recv()
+            if not raw:
+                raise WebSocketException("connection closed by server")
+            self.dispatch(json.loads(raw))
+
+    def close(self):
+        if self.ws is not None:
+            try:
+                self.ws.close()
+            except (WebSocketException, OSError):
+                pass
+            self.ws = None
+
+    def stop(self):
+        super().stop()
+        self.close()
+
+    def run(self):
+        logger.info(f"{self} starting")
+        delay = INITIAL_RECONNECT_DELAY
+        while not self.is_shutdown():
+            try:
+                self.connect()
+                delay = INITIAL_RECONNECT_DELAY
+                self.receive_messages()
+            except (WebSocketException, OSError, ValueError) as e:
+                if self.is_shutdown():
+                    break
+                logger.warning(f"{self} disconnected ({e}), reconnecting in {delay}s")
+                self.close()
+                sleep(delay)
+                delay = min(delay*2, MAX_RECONNECT_DELAY)
+        self.close()
+        logger.info(f"{self} terminating")
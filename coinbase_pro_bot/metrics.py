@@ -0,0 +1,205 @@
+import json
+import os
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time
+
+# Upper bounds in seconds, shared by every histogram
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRICS_PORT = 9108
+SNAPSHOT_INTERVAL = 60
+
+# The process wide MetricsRegistry, None while metrics are disabled. Call
+# sites check it before taking any timings, so disabled metrics cost one
+# global lookup:
+#
+#     if metrics.REGISTRY is not None:
+#         metrics.REGISTRY.observe('api_latency_seconds', waited, endpoint=name)
+REGISTRY = None
+
+
+def enable():
+    global REGISTRY
+    if REGISTRY is None:
+        REGISTRY = MetricsRegistry()
+    return REGISTRY
+
+
+def disable():
+    global REGISTRY
+    REGISTRY = None
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Histogram(object):
+
+    __slots__ = ['buckets', 'counts', 'count', 'sum']
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+# Counters and histograms keyed by name and label values. Updates take one
+# lock per registry, which is uncontended next to the work being measured.
+# Gauges are not stored, they are read from callbacks when exported, so
+# e.g. queue depths cost nothing until someone asks for them.
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    # callback() is called at export time and must return a number
+    def gauge(self, name, callback, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = callback
+
+    def remove_gauges(self, **labels):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            self.gauges = {k: v for k, v in self.gauges.items() if k[1] != labels}
+
+    def collect(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {k: (h.count, h.sum, list(h.cumulative())) for k, h in self.histograms.items()}
+            gauges = dict(self.gauges)
+        return counters, histograms, {k: callback() for k, callback in gauges.items()}
+
+    def to_prometheus(self):
+        counters, histograms, gauges = self.collect()
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), value in sorted(gauges.items()):
+            header(name, 'gauge')
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), (count, total, buckets) in sorted(histograms.items()):
+            header(name, 'histogram')
+            for bound, cumulative in buckets:
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        counters, histograms, gauges = self.collect()
+        return {
+            'time': time(),
+            'counters': [{'name': n, 'labels': dict(l), 'value': v} for (n, l), v in counters.items()],
+            'gauges': [{'name': n, 'labels': dict(l), 'value': v} for (n, l), v in gauges.items()],
+            'histograms': [
+                {'name': n, 'labels': dict(l), 'count': count, 'sum': total,
+                 'buckets': {str(bound): cumulative for bound, cumulative in buckets}}
+                for (n, l), (count, total, buckets) in histograms.items()
+            ],
+        }
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.to_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serves the registry in the Prometheus text format on
+# http://host:port/metrics, from a daemon thread
+class MetricsServer(threading.Thread):
+
+    def __init__(self, registry, host='127.0.0.1', port=METRICS_PORT):
+        super().__init__(name='MetricsServer', daemon=True)
+        self.server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.server.registry = registry
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Writes the registry to file_name as JSON every interval seconds
+class MetricsSnapshotWriter(threading.Thread):
+
+    def __init__(self, registry, file_name, interval=SNAPSHOT_INTERVAL):
+        super().__init__(name='MetricsSnapshotWriter', daemon=True)
+        self.registry = registry
+        self.file_name = file_name
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def write_snapshot(self):
+        os.makedirs(os.path.dirname(self.file_name) or '.', exist_ok=True)
+        with open(self.file_name + '.tmp', 'w') as f:
+            json.dump(self.registry.to_dict(), f)
+        os.replace(self.file_name + '.tmp', self.file_name)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write_snapshot()
+        self.write_snapshot()
+
+    def stop(self):
+        self.stopped.set()
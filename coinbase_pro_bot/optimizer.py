@@ -0,0 +1,117 @@
+import json
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+from backtester import backtest, IndicatorCache
+from candle_cache import CandleCache
+from utilities import (
+    FIAT_MARKETS,
+    BASE_CSV_DATA,
+    DEFAULT_PARAMETERS,
+    StrategyParameters,
+)
+
+PARAMETERS_FILE = os.path.join(BASE_CSV_DATA, "optimized_parameters.json")
+
+DEFAULT_SEARCH_SPACE = {
+    'rsi_oversold': [20, 25, 30, 35],
+    'rsi_overbought': [65, 70, 75, 80],
+    'rsi_period': [7, 10, 14, 21],
+    'macd_fast': [8, 12, 16],
+    'macd_slow': [21, 26, 34],
+    'macd_signal': [5, 9, 12],
+    'trend_threshold': [-0.001, -0.0005, -0.00025],
+}
+
+# Combinations per worker task, enough to amortize loading the candles and
+# computing the shared indicator arrays
+CHUNK_SIZE = 250
+TOP_RESULTS = 10
+
+
+def is_valid(parameters):
+    return parameters.macd_fast < parameters.macd_slow and parameters.rsi_oversold < parameters.rsi_overbought
+
+
+def grid_search_space(search_space=DEFAULT_SEARCH_SPACE):
+    values = [search_space.get(field, [getattr(DEFAULT_PARAMETERS, field)]) for field in StrategyParameters._fields]
+    return [p for p in (StrategyParameters(*v) for v in product(*values)) if is_valid(p)]
+
+
+def random_search_space(count, search_space=DEFAULT_SEARCH_SPACE, seed=None):
+    space = grid_search_space(search_space)
+    if count >= len(space):
+        return space
+    return random.Random(seed).sample(space, count)
+
+
+# Sorting by periods keeps combinations that share indicator arrays in the
+# same chunk
+def chunk_combinations(combinations, size=CHUNK_SIZE):
+    combinations = sorted(combinations, key=lambda p: (p.macd_fast, p.macd_slow, p.macd_signal, p.rsi_period))
+    return [combinations[i:i+size] for i in range(0, len(combinations), size)]
+
+
+def evaluate_chunk(job):
+    product_id, granularity, base_dir, combinations = job
+    candles = CandleCache(base_dir).load(product_id, granularity)
+    indicator_cache = IndicatorCache(candles.close)
+    results = []
+    for parameters in combinations:
+        result = backtest(candles, product_id, granularity, parameters, indicator_cache=indicator_cache)
+        summary = result.summary()
+        summary['parameters'] = parameters._asdict()
+        results.append(summary)
+    return results
+
+
+def rank(results, top=TOP_RESULTS):
+    rankings = {}
+    for summary in results:
+        key = f"{summary['product_id']}:{summary['granularity']}"
+        rankings.setdefault(key, []).append(summary)
+    for key in rankings:
+        rankings[key].sort(key=lambda s: s['pnl'], reverse=True)
+        rankings[key] = rankings[key][:top]
+    return rankings
+
+
+# Evaluates every combination against the stored history of each market on
+# all cores and returns the best combinations per "product:granularity"
+def optimize(product_ids, granularities, combinations, base_dir=None, processes=None, top=TOP_RESULTS):
+    jobs = [(product_id, granularity, base_dir, chunk)
+            for product_id in product_ids
+            for granularity in granularities
+            for chunk in chunk_combinations(combinations)]
+    results = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for chunk_results in executor.map(evaluate_chunk, jobs):
+            results.extend(chunk_results)
+    return rank(results, top)
+
+
+def save_rankings(rankings, file_name=PARAMETERS_FILE):
+    os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+    with open(file_name, 'w') as f:
+        json.dump(rankings, f, indent=2, default=float)
+
+
+# Returns {(product_id, granularity): StrategyParameters} with the best
+# ranked combination for each market
+def load_best_parameters(file_name=PARAMETERS_FILE):
+    with open(file_name, 'r') as f:
+        rankings = json.load(f)
+    best = {}
+    for key, summaries in rankings.items():
+        if len(summaries) == 0:
+            continue
+        product_id, granularity = key.rsplit(':', 1)
+        best[(product_id, int(granularity))] = StrategyParameters(**summaries[0]['parameters'])
+    return best
+
+
+if __name__ == "__main__":
+    rankings = optimize([f"{crypto}-USD" for crypto in FIAT_MARKETS], [3600], grid_search_space())
+    save_rankings(rankings)
@@ -0,0 +1,165 @@
+import threading
+from time import monotonic
+
+import metrics
+from crypto_worker import CryptoWorker
+from crypto_message import (
+    BuyOrderRequestMessage,
+    BuyOrderResponseMessage,
+    SellOrderRequestMessage,
+    SellOrderResponseMessage,
+)
+from crypto_logger import logger
+from rate_limiter import is_rate_limited_response, PRIVATE_ENDPOINT
+from utilities import MAX_INVESTMENT
+
+# Seconds between get_order polls while an order is open
+ORDER_POLL_INTERVAL = 0.5
+MAX_ORDER_ATTEMPTS = 5
+
+ORDER_DONE = 'done'
+
+ORDER_REQUESTS = (BuyOrderRequestMessage, SellOrderRequestMessage)
+
+
+def is_error_response(response):
+    return not isinstance(response, dict) or 'message' in response
+
+
+# Places market orders on its own thread and client, so an order never waits
+# behind market data requests in the ApiRequestManager queue. It shares the
+# manager's rate limiter for the private endpoints, polls every open order
+# until the exchange reports it done, and answers the sender with a
+# Buy/SellOrderResponseMessage carrying the final order (or the error).
+class OrderExecutor(CryptoWorker):
+
+    def __init__(self, client_factory, rate_limiter, poll_interval=ORDER_POLL_INTERVAL):
+        super().__init__(client_factory())
+        self.rate_limiter = rate_limiter
+        self.poll_interval = poll_interval
+        # order id -> (request message, monotonic time it was placed)
+        self.open_orders = {}
+        self.attempts = {}
+        # {'signal_to_order': [...], 'order_to_fill': [...]} in seconds
+        self.latencies = {'signal_to_order': [], 'order_to_fill': []}
+        self.latency_lock = threading.Lock()
+        # Optional Ledger that every fill is applied to before the sender
+        # hears about it
+        self.ledger = None
+
+    def __str__(self):
+        return f"OrderExecutor({len(self.open_orders)} open)"
+
+    def record_latency(self, name, seconds):
+        with self.latency_lock:
+            self.latencies[name].append(seconds)
+        if metrics.REGISTRY is not None:
+            metrics.REGISTRY.observe(f"{name}_seconds", seconds)
+
+    # {name: (count, mean seconds, max seconds)}
+    def get_latency_stats(self):
+        with self.latency_lock:
+            return {name: (len(values), sum(values)/len(values), max(values))
+                    for name, values in self.latencies.items() if len(values) > 0}
+
+    def call(self, method, *args, **kwargs):
+        self.rate_limiter.acquire(PRIVATE_ENDPOINT)
+        response = getattr(self.client, method)(*args, **kwargs)
+        if is_rate_limited_response(response):
+            backoff = self.rate_limiter.rate_limited(PRIVATE_ENDPOINT)
+            logger.warning(f"{self} hit the private rate limit, backing off {backoff}s")
+            return None
+        self.rate_limiter.succeeded(PRIVATE_ENDPOINT)
+        return response
+
+    def respond(self, msg, data):
+        if isinstance(msg, BuyOrderRequestMessage):
+            response = BuyOrderResponseMessage(self, msg.sender, data)
+        else:
+            response = SellOrderResponseMessage(self, msg.sender, data)
+        msg.sender.add_message_to_queue(response)
+
+    # A placement that raised is answered as failed rather than retried, since
+    # the exchange may or may not have taken the order
+    def place_order(self, msg):
+        try:
+            if isinstance(msg, BuyOrderRequestMessage):
+                response = self.call('place_market_order', msg.product_id, 'buy', funds=msg.funds or MAX_INVESTMENT)
+            else:
+                response = self.call('place_market_order', msg.product_id, 'sell', size=msg.size)
+        except Exception as e:
+            logger.exception(f"{self} failed to place {msg}")
+            self.attempts.pop(msg, None)
+            self.respond(msg, {'message': f"Order request failed: {e}"})
+            return
+        if response is None:
+            self.attempts[msg] = self.attempts.get(msg, 0) + 1
+            if self.attempts[msg] < MAX_ORDER_ATTEMPTS:
+                self.mailbox.requeue(msg)
+                return
+            response = {'message': 'Rate limit exceeded'}
+        self.attempts.pop(msg, None)
+        placed_at = monotonic()
+        self.record_latency('signal_to_order', placed_at - msg.signaled_at)
+        if is_error_response(response):
+            logger.error(f"{self} could not place {msg}: {response}")
+            self.respond(msg, response)
+            return
+        logger.info(f"{self} placed order {response['id']} for {msg.product_id}")
+        self.open_orders[response['id']] = (msg, placed_at)
+        self.check_order(response)
+
+    def check_order(self, order):
+        msg, placed_at = self.open_orders[order['id']]
+        if order.get('status') != ORDER_DONE:
+            return
+        del self.open_orders[order['id']]
+        self.record_latency('order_to_fill', monotonic() - placed_at)
+        if self.ledger is not None:
+            self.ledger.apply_fill(order)
+        logger.info(f"{self} order {order['id']} for {msg.product_id} filled {order.get('filled_size')}")
+        self.respond(msg, order)
+
+    def poll_orders(self):
+        for order_id in list(self.open_orders):
+            try:
+                order = self.call('get_order', order_id)
+            except Exception:
+                # Left open and polled again next time
+                logger.exception(f"{self} failed to check order {order_id}")
+                continue
+            if order is None:
+                continue
+            if is_error_response(order):
+                msg, _ = self.open_orders.pop(order_id)
+                logger.error(f"{self} lost track of order {order_id}: {order}")
+                self.respond(msg, order)
+                continue
+            self.check_order(order)
+
+    def process_message(self, msg):
+        if isinstance(msg, ORDER_REQUESTS):
+            self.place_order(msg)
+
+    def run(self):
+        logger.info(f"{self} starting")
+        next_poll = monotonic() + self.poll_interval
+        while not self.is_shutdown():
+            timeout = max(next_poll - monotonic(), 0) if len(self.open_orders) > 0 else None
+            msg = self.wait_for_message(timeout)
+            try:
+                self.process_message(msg)
+            except Exception:
+                # Answered so the monitor isn't left waiting on it
+                logger.exception(f"{self} failed to process {msg}")
+                if isinstance(msg, ORDER_REQUESTS) and msg not in self.attempts:
+                    self.respond(msg, {'message': 'Order request failed'})
+            if len(self.open_orders) > 0 and monotonic() >= next_poll:
+                try:
+                    self.poll_orders()
+                except Exception:
+                    logger.exception(f"{self} failed to poll open orders")
+                next_poll = monotonic() + self.poll_interval
+            elif len(self.open_orders) == 0:
+                next_poll = monotonic() + self.poll_interval
+        logger.info(f"{self} terminating")
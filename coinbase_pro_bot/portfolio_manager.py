@@ -1,53 +1,106 @@
+from time import monotonic
+
+import clock
+import metrics
 from crypto_worker import CryptoWorker
 from api_request_manager import ApiRequestManager
 from crypto_monitor import CryptoMonitor
+from market_feed import MarketDataFeed
+from candle_builder import CandleBuilder
+from candle_cache import CandleCache
+from scheduler import TimerWheel
+from optimizer import load_best_parameters
+from ledger import Ledger, RECONCILE_INTERVAL
 from crypto_logger import logger
 from crypto_message import (
     AccountBalanceRequestMessage,
     AccountBalanceResponseMessage,
 )
-from time import sleep
-from utilities import FIAT_MARKETS
+from utilities import FIAT_MARKETS, DEFAULT_PARAMETERS
 
 class PortfolioManager(CryptoWorker):
 
-    def __init__(self, key_file):
+    # With use_market_feed, prices and closed candles for every granularity
+    # come from one websocket subscription and REST is only used for history.
+    # Metrics are only collected if a metrics_port to serve them on or a
+    # metrics_file to write snapshots to is given.
+    def __init__(self, key_file, request_concurrency=1, use_market_feed=False,
+                 granularities=(3600,), use_candle_cache=False, parameters_file=None,
+                 metrics_port=None, metrics_file=None, client_factory=None):
         super().__init__(self)
-        self.client = ApiRequestManager(key_file)
+        self.metrics_exporters = []
+        if metrics_port is not None or metrics_file is not None:
+            registry = metrics.enable()
+            if metrics_port is not None:
+                self.metrics_exporters.append(metrics.MetricsServer(registry, port=metrics_port))
+            if metrics_file is not None:
+                self.metrics_exporters.append(metrics.MetricsSnapshotWriter(registry, metrics_file))
+            for exporter in self.metrics_exporters:
+                exporter.start()
+        self.client = ApiRequestManager(key_file, request_concurrency, client_factory)
         self.client.start()
+        # Balances shared by the order executor, which applies fills, and the
+        # monitors, which read snapshots; get_accounts only reconciles it
+        self.ledger = Ledger()
+        self.client.order_executor.ledger = self.ledger
+        self.reconcile_fills = None
         self.historical_data_monitors = []
+        self.scheduler = TimerWheel()
+        self.market_feed = MarketDataFeed() if use_market_feed else None
+        self.granularities = granularities
+        self.candle_builders = {}
+        self.candle_cache = CandleCache() if use_candle_cache else None
+        # Per market parameters ranked by the optimizer, anything missing
+        # trades with the defaults
+        self.parameters = load_best_parameters(parameters_file) if parameters_file else {}
 
     def initialize_portfolio_manager(self):
+        self.scheduler.start()
         for crypto in FIAT_MARKETS:
             pair = f"{crypto}-USD"
-            for granularity in [3600]:
+            if self.market_feed is not None:
+                self.candle_builders[pair] = CandleBuilder(pair)
+                self.market_feed.register(pair, self.candle_builders[pair])
+            for granularity in self.granularities:
                 cm = CryptoMonitor(self.client, pair, granularity)
+                cm.candle_cache = self.candle_cache
+                cm.scheduler = self.scheduler
+                cm.ledger = self.ledger
+                cm.parameters = self.parameters.get((pair, granularity), DEFAULT_PARAMETERS)
+                if self.market_feed is not None:
+                    cm.use_ticker_feed = True
+                    cm.use_candle_feed = True
+                    self.market_feed.register(pair, cm)
+                    self.candle_builders[pair].register(granularity, cm)
                 cm.start()
                 self.historical_data_monitors.append(cm)
+        if self.market_feed is not None:
+            self.market_feed.start()
 
     def request_available_balance(self):
+        self.reconcile_fills = self.ledger.snapshot().fills
         msg = AccountBalanceRequestMessage(self, self.client)
         self.client.add_message_to_priority_queue(msg)
 
     def process_message(self, msg):
         if msg is not None:
             if isinstance(msg, AccountBalanceResponseMessage):
-                pass
+                if not isinstance(msg.data, list):
+                    logger.warning(f"{self} could not fetch accounts: {msg.data}")
+                elif self.ledger.reconcile(msg.data, self.reconcile_fills) is None:
+                    logger.info(f"{self} skipped reconciling, a fill landed mid request")
             else:
                 return
 
-    def process_messages(self):
-        while self.get_remaining_message_count() > 0:
-            msg = self.get_next_message_from_queue()
-            self.process_message(msg)
-
     def run(self):
         logger.info(f"{self} starting")
         self.initialize_portfolio_manager()
-        #self.request_available_balance()
+        next_reconcile = monotonic()
         while not self.is_shutdown():
-            self.process_messages()
-            sleep(1)
+            if monotonic() >= next_reconcile:
+                self.request_available_balance()
+                next_reconcile = monotonic() + clock.real_seconds(RECONCILE_INTERVAL)
+            self.process_message(self.wait_for_message(max(next_reconcile - monotonic(), 0)))
         logger.info(f"{self} terminating")
 
 
@@ -0,0 +1,107 @@
+import threading
+from time import monotonic, sleep
+
+import clock
+import metrics
+
+PUBLIC_ENDPOINT = 'public'
+PRIVATE_ENDPOINT = 'private'
+
+# (requests per second, burst) as published by the exchange
+DEFAULT_RATE_LIMITS = {
+    PUBLIC_ENDPOINT: (3, 6),
+    PRIVATE_ENDPOINT: (5, 10),
+}
+
+INITIAL_BACKOFF = 1
+MAX_BACKOFF = 60
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+# The limits in real time. With a SimulatedClock installed they hold per
+# second of market time, so a simulation sees the same budget per candle as
+# live trading.
+def market_rate_limits(limits=DEFAULT_RATE_LIMITS):
+    return {name: (rate/clock.real_seconds(1), burst) for name, (rate, burst) in limits.items()}
+
+
+def is_rate_limited_response(response):
+    return isinstance(response, dict) and 'rate limit' in str(response.get('message', '')).lower()
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill)*self.rate)
+        self.last_refill = now
+
+    # Takes a token if one is available and returns 0, otherwise returns how
+    # long the caller should wait before trying again
+    def try_acquire(self):
+        with self.lock:
+            now = monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            self.refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens)/self.rate
+
+    def acquire(self):
+        waited = 0
+        wait = self.try_acquire()
+        while wait > 0:
+            sleep(wait)
+            waited += wait
+            wait = self.try_acquire()
+        return waited
+
+    def block(self, delay):
+        with self.lock:
+            now = monotonic()
+            self.refill(now)
+            self.tokens = 0
+            self.blocked_until = max(self.blocked_until, now + delay)
+
+
+# One bucket per endpoint class with exponential backoff whenever the
+# exchange answers with a rate limit error.
+class RateLimiter(object):
+
+    def __init__(self, limits=DEFAULT_RATE_LIMITS):
+        self.buckets = {name: TokenBucket(rate, burst) for name, (rate, burst) in market_rate_limits(limits).items()}
+        self.backoffs = {name: 0 for name in limits}
+        self.stall_time = {name: 0.0 for name in limits}
+        self.lock = threading.Lock()
+
+    def acquire(self, name):
+        waited = self.buckets[name].acquire()
+        with self.lock:
+            self.stall_time[name] += waited
+        if waited > 0 and metrics.REGISTRY is not None:
+            metrics.REGISTRY.increment('rate_limit_stalls_total', endpoint=name)
+            metrics.REGISTRY.increment('rate_limit_stall_seconds_total', waited, endpoint=name)
+        return waited
+
+    def rate_limited(self, name):
+        with self.lock:
+            self.backoffs[name] = min(max(self.backoffs[name]*2, INITIAL_BACKOFF), MAX_BACKOFF)
+            backoff = self.backoffs[name]
+        self.buckets[name].block(clock.real_seconds(backoff))
+        return backoff
+
+    def succeeded(self, name):
+        with self.lock:
+            self.backoffs[name] = 0
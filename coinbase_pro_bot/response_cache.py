@@ -0,0 +1,122 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+import clock
+from crypto_message import HistoricalDataRequestMessage, ProductTickerRequestMessage
+
+# Seconds a response may be reused. Tickers move constantly; candle windows
+# only change when their last candle does.
+TICKER_TTL = 1.0
+HISTORY_TTL = 10.0
+MAX_CACHE_ENTRIES = 1024
+
+
+# Requests with the same key get the same answer from the exchange. Only
+# public market data is keyed, account and order requests are never shared.
+def request_key(msg):
+    if isinstance(msg, HistoricalDataRequestMessage):
+        return ('history', msg.product_id, msg.granularity, msg.start, msg.end)
+    if isinstance(msg, ProductTickerRequestMessage):
+        return ('ticker', msg.product_id)
+    return None
+
+
+def is_cacheable_response(data):
+    if isinstance(data, dict):
+        return 'message' not in data
+    return isinstance(data, list)
+
+
+# Sits in front of the REST calls in the ApiRequestManager. The first request
+# for a key is dispatched and later ones wait on it instead of making their
+# own call; its response is then handed to every waiting request and kept
+# for a short TTL. Responses are shared between senders, not copied.
+class ResponseCache(object):
+
+    def __init__(self, max_entries=MAX_CACHE_ENTRIES, ticker_ttl=TICKER_TTL, history_ttl=HISTORY_TTL):
+        self.max_entries = max_entries
+        self.ttls = {'ticker': ticker_ttl, 'history': history_ttl}
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.hits = 0
+        self.coalesced = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, data = entry
+            if expires <= monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        with self.lock:
+            self.store(key, data)
+
+    # Called with the lock held
+    def store(self, key, data):
+        self.entries[key] = (monotonic() + clock.real_seconds(self.ttls[key[0]]), data)
+        self.entries.move_to_end(key)
+        self.evict()
+
+    # Expired entries go first, then the least recently used. Called with
+    # the lock held.
+    def evict(self):
+        if len(self.entries) <= self.max_entries:
+            return
+        now = monotonic()
+        for key in [k for k, (expires, _) in self.entries.items() if expires <= now]:
+            del self.entries[key]
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    # Returns True if msg should be sent upstream, False if it was attached
+    # to an identical request already in flight. A request that was put back
+    # after a rate limit is still the leader for its key.
+    def join(self, msg):
+        key = request_key(msg)
+        if key is None:
+            return True
+        with self.lock:
+            waiting = self.in_flight.get(key)
+            if waiting is None:
+                self.in_flight[key] = [msg]
+                return True
+            if waiting[0] is msg:
+                return True
+            waiting.append(msg)
+            self.coalesced += 1
+            return False
+
+    # Stores the leader's response and returns every request it answers,
+    # the leader included. Both happen under one lock so a request for the
+    # same key always finds either the request in flight or its entry.
+    def complete(self, msg, data):
+        key = request_key(msg)
+        if key is None:
+            return [msg]
+        with self.lock:
+            waiting = self.in_flight.pop(key, [msg])
+            if is_cacheable_response(data):
+                self.store(key, data)
+        return waiting
+
+    # Drops the in flight entry of a request that failed, returning the
+    # requests that were waiting on it
+    def abandon(self, msg):
+        key = request_key(msg)
+        if key is None:
+            return []
+        with self.lock:
+            waiting = self.in_flight.pop(key, [msg])
+        return waiting[1:]
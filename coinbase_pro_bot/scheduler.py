@@ -0,0 +1,83 @@
+import threading
+from math import ceil
+from time import monotonic
+
+from crypto_logger import logger
+
+TICK_SECONDS = 0.25
+WHEEL_SLOTS = 512
+
+# Registered workers are started this far apart within each candle period,
+# at most MAX_SPREAD seconds after its close, so the requests for every
+# market do not all land on the rate limiter at once
+SPREAD_INTERVAL = 0.5
+MAX_SPREAD = 30
+
+
+def next_boundary(now, granularity):
+    return (int(now)//granularity + 1)*granularity
+
+
+# Hashed timing wheel run by one thread for every monitor. Timers are
+# hashed into WHEEL_SLOTS buckets of TICK_SECONDS each and carry the number
+# of full turns left, so scheduling and firing are O(1) however far ahead
+# the timer is. Firing only hands a message to the worker's mailbox, the
+# work itself still happens on the worker's own thread.
+class TimerWheel(threading.Thread):
+
+    def __init__(self, tick=TICK_SECONDS, slots=WHEEL_SLOTS):
+        super().__init__(name='TimerWheel', daemon=True)
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.start_time = monotonic()
+        self.current_tick = 0
+        self.registered = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def __str__(self):
+        return f"TimerWheel({len(self)} timers)"
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(slot) for slot in self.slots)
+
+    # Returns the offset after each candle close the worker should use
+    def register(self, worker):
+        with self.lock:
+            offset = (self.registered*SPREAD_INTERVAL) % MAX_SPREAD
+            self.registered += 1
+        return offset
+
+    # Delivers msg to worker's queue after delay seconds
+    def schedule(self, delay, worker, msg):
+        with self.lock:
+            due = max(ceil((monotonic() + delay - self.start_time)/self.tick), self.current_tick + 1)
+            self.slots[due % len(self.slots)].append((due, worker, msg))
+
+    def cancel(self, worker):
+        with self.lock:
+            for slot in self.slots:
+                slot[:] = [timer for timer in slot if timer[1] is not worker]
+
+    def advance(self):
+        with self.lock:
+            self.current_tick += 1
+            slot = self.slots[self.current_tick % len(self.slots)]
+            due = [timer for timer in slot if timer[0] <= self.current_tick]
+            slot[:] = [timer for timer in slot if timer[0] > self.current_tick]
+        for _, worker, msg in due:
+            if not worker.is_shutdown():
+                worker.add_message_to_queue(msg)
+
+    def stop(self):
+        self.stopped.set()
+
+    def is_shutdown(self):
+        return self.stopped.is_set()
+
+    def run(self):
+        logger.info(f"{self} starting")
+        while not self.stopped.wait(max(self.start_time + (self.current_tick + 1)*self.tick - monotonic(), 0)):
+            self.advance()
+        logger.info(f"{self} terminating")
@@ -0,0 +1,99 @@
+import numpy as np
+
+from candle_cache import CandleCache
+from data_processing import determine_next_states
+from indicators import macd, rsi, linear_slope, indicator_warmup
+from utilities import (
+    FIAT_MARKETS,
+    MAX_CANDLES_PER_REQUEST,
+    DEFAULT_PARAMETERS,
+    STATE_DEFAULT,
+    STATE_BUY,
+    STATE_SELL,
+)
+
+
+# Evaluates the monitor state machine for many markets of one granularity
+# in a single pass. The newest `window` closes of every market are stacked
+# into a (markets x time) matrix, the indicators are computed along the time
+# axis for all rows at once, and the states are advanced with array
+# operations, so the per market cost is a few array elements rather than a
+# DataFrame pipeline each.
+class MarketScreener(object):
+
+    def __init__(self, granularity, parameters=DEFAULT_PARAMETERS, window=MAX_CANDLES_PER_REQUEST):
+        self.granularity = granularity
+        self.parameters = parameters
+        self.window = window
+        self.states = {}
+
+    def get_state(self, product_id):
+        return self.states.get(product_id, STATE_DEFAULT)
+
+    # Markets whose newest candle is the common newest one and that have a
+    # full window, in a stable order. Stale or short series are left out.
+    def aligned_markets(self, candles):
+        latest = max((series.last_timestamp() for series in candles.values() if len(series) > 0), default=None)
+        return [product_id for product_id, series in sorted(candles.items())
+                if len(series) >= self.window and series.last_timestamp() == latest]
+
+    def close_matrix(self, candles, product_ids, prices=None):
+        closes = np.empty((len(product_ids), self.window + (prices is not None)))
+        for row, product_id in enumerate(product_ids):
+            closes[row, :self.window] = candles[product_id].close[-self.window:]
+            if prices is not None:
+                closes[row, -1] = prices.get(product_id, closes[row, -2])
+        return closes
+
+    # Takes {product_id: CandleSeries} and optionally {product_id: price}
+    # to evaluate as a provisional candle, like a monitor does with a
+    # ticker. Returns [(product_id, previous state, new state)] for the
+    # markets that moved. BUY and SELL are reported once and then reset to
+    # the default state.
+    def evaluate(self, candles, prices=None):
+        product_ids = self.aligned_markets(candles)
+        if len(product_ids) == 0:
+            return []
+        p = self.parameters
+        closes = self.close_matrix(candles, product_ids, prices)
+        _, _, macd_line, signal = macd(closes, p.macd_fast, p.macd_slow, p.macd_signal)
+        rsi_line = rsi(closes, p.rsi_period)[0]
+        trend = closes[:, indicator_warmup(p.macd_fast, p.macd_slow, p.macd_signal, p.rsi_period):]
+        # Markets trending down too steeply are skipped, as in CryptoMonitor
+        tradable = linear_slope(trend)/closes[:, -1] >= p.trend_threshold
+
+        states = np.array([self.get_state(product_id) for product_id in product_ids])
+        next_states = determine_next_states(
+            rsi_line[:, -1],
+            macd_line[:, -1] - signal[:, -1],
+            states,
+            p.rsi_oversold,
+            p.rsi_overbought,
+        )
+        next_states = np.where(tradable, next_states, states)
+
+        changed = []
+        for row in np.flatnonzero(next_states != states):
+            product_id = product_ids[row]
+            changed.append((product_id, int(states[row]), int(next_states[row])))
+            if next_states[row] in (STATE_BUY, STATE_SELL):
+                self.states[product_id] = STATE_DEFAULT
+            else:
+                self.states[product_id] = int(next_states[row])
+        return changed
+
+
+def load_cached_candles(product_ids, granularity, window=MAX_CANDLES_PER_REQUEST, base_dir=None):
+    cache = CandleCache(base_dir)
+    candles = {}
+    for product_id in product_ids:
+        last = cache.last_timestamp(product_id, granularity)
+        candles[product_id] = cache.load(product_id, granularity, last - (window - 1)*granularity)
+    return candles
+
+
+if __name__ == "__main__":
+    screener = MarketScreener(3600)
+    markets = [f"{crypto}-USD" for crypto in FIAT_MARKETS]
+    for product_id, before, after in screener.evaluate(load_cached_candles(markets, 3600)):
+        print(f"{product_id}: {before} -> {after}")
@@ -0,0 +1,272 @@
+import multiprocessing
+import sys
+from time import monotonic
+
+import clock
+from api_request_manager import ApiRequestManager
+from candle_store import CandleSeries
+from crypto_monitor import CryptoMonitor, CANDLE_CLOSE_DELAY, SLEEP_TIME
+from crypto_worker import CryptoWorker
+from crypto_message import (
+    HistoricalDataRequestMessage,
+    HistoricalDataResponseMessage,
+    message_to_bytes,
+    message_from_bytes,
+)
+from crypto_logger import logger
+from crypto_mailbox import PRIORITY_LANE, DEFAULT_LANE
+from scheduler import TimerWheel, next_boundary
+from shared_candles import SharedCandlePublisher, SharedCandleReader
+from utilities import FIAT_MARKETS, DEFAULT_PARAMETERS
+
+# Real seconds to wait for a history response before asking again
+INGEST_REQUEST_TIMEOUT = 60
+
+
+def monitor_address(product_id, granularity):
+    return f"{product_id}/{granularity}"
+
+
+# Stands in for the ApiRequestManager inside a shard process. Requests are
+# flattened to (shard, sender address, lane, message bytes) for the gateway.
+class GatewayProxy(object):
+
+    def __init__(self, shard_id, request_queue):
+        self.shard_id = shard_id
+        self.request_queue = request_queue
+
+    def __str__(self):
+        return f"GatewayProxy({self.shard_id})"
+
+    def send(self, msg, lane):
+        address = monitor_address(msg.sender.product_id, msg.sender.granularity)
+        self.request_queue.put((self.shard_id, address, lane, message_to_bytes(msg)))
+
+    def add_message_to_queue(self, msg):
+        self.send(msg, DEFAULT_LANE)
+
+    def add_message_to_priority_queue(self, msg):
+        self.send(msg, PRIORITY_LANE)
+
+
+# Stands in for a remote monitor inside the gateway process, so the
+# ApiRequestManager answers it exactly like a local sender
+class ShardProxy(object):
+
+    def __init__(self, address, response_queue):
+        self.address = address
+        self.response_queue = response_queue
+
+    def __str__(self):
+        return f"ShardProxy({self.address})"
+
+    def add_message_to_queue(self, msg):
+        self.response_queue.put((self.address, message_to_bytes(msg)))
+
+
+# Runs in the gateway process when the candle series are shared. Fetches the
+# history of every market just after each candle close and appends the
+# closed candles to the market's ring, so the shards read one copy from
+# shared memory instead of each requesting their own.
+class SharedCandleIngest(CryptoWorker):
+
+    def __init__(self, client, publisher, markets, request_timeout=INGEST_REQUEST_TIMEOUT):
+        super().__init__(client)
+        self.publisher = publisher
+        self.request_timeout = request_timeout
+        # (product_id, granularity) -> monotonic time of its next request
+        self.due = {market: 0 for market in markets}
+        # Series whose last answer was missing the newest closed candle; their
+        # next request skips the response cache, which still holds that answer
+        self.retrying = set()
+
+    def __str__(self):
+        return f"SharedCandleIngest({len(self.due)} series)"
+
+    # Real seconds until just after the next candle close
+    def get_next_close_delay(self, granularity):
+        now = clock.now()
+        return clock.real_seconds(next_boundary(now, granularity) + CANDLE_CLOSE_DELAY - now)
+
+    def request_due(self):
+        now = monotonic()
+        for (product_id, granularity), due in self.due.items():
+            if due <= now:
+                self.client.add_message_to_queue(HistoricalDataRequestMessage(
+                    self,
+                    self.client,
+                    product_id,
+                    granularity=granularity,
+                    refresh=(product_id, granularity) in self.retrying,
+                ))
+                # Asked again if the request is lost
+                self.due[(product_id, granularity)] = now + self.request_timeout
+
+    def process_message(self, msg):
+        if not isinstance(msg, HistoricalDataResponseMessage):
+            return
+        key = (msg.product_id, msg.granularity)
+        if key not in self.due:
+            return
+        if not isinstance(msg.data, list) or len(msg.data) == 0:
+            logger.warning(f"{self} got no history for {msg.product_id}: {msg.data}")
+            self.due[key] = monotonic() + clock.real_seconds(SLEEP_TIME)
+            return
+        now = clock.now()
+        candles = CandleSeries.from_list(msg.data)
+        candles = candles[candles.timestamp + msg.granularity <= now]
+        self.publisher.publish(msg.product_id, msg.granularity, candles)
+        if candles.last_timestamp() < now - now % msg.granularity - msg.granularity:
+            # The exchange hasn't published the candle that just closed yet
+            self.retrying.add(key)
+            self.due[key] = monotonic() + clock.real_seconds(CANDLE_CLOSE_DELAY)
+        else:
+            self.retrying.discard(key)
+            self.due[key] = monotonic() + self.get_next_close_delay(msg.granularity)
+
+    def run(self):
+        logger.info(f"{self} starting")
+        while not self.is_shutdown():
+            self.request_due()
+            self.process_message(self.wait_for_message(max(min(self.due.values()) - monotonic(), 0)))
+        logger.info(f"{self} terminating")
+
+
+# With shared_markets, the gateway is also the ingest process writing the
+# candle rings of those markets
+def run_gateway(key_file, request_queue, response_queues, concurrency, shared_markets=None):
+    manager = ApiRequestManager(key_file, concurrency)
+    manager.start()
+    publisher = None
+    ingest = None
+    if shared_markets:
+        publisher = SharedCandlePublisher(create=False)
+        ingest = SharedCandleIngest(manager, publisher, shared_markets)
+        ingest.start()
+    proxies = {}
+    while True:
+        item = request_queue.get()
+        if item is None:
+            break
+        shard_id, address, lane, wire = item
+        if (shard_id, address) not in proxies:
+            proxies[(shard_id, address)] = ShardProxy(address, response_queues[shard_id])
+        msg = message_from_bytes(wire, proxies[(shard_id, address)], manager)
+        if lane == PRIORITY_LANE:
+            manager.add_message_to_priority_queue(msg)
+        else:
+            manager.add_message_to_queue(msg)
+    if ingest is not None:
+        ingest.stop()
+        ingest.join()
+        publisher.close()
+    manager.stop()
+    manager.join()
+
+
+# With shared_candles, monitors read their candles from the rings the
+# gateway writes and only request tickers
+def run_shard(shard_id, markets, request_queue, response_queue, parameters, shared_candles=False):
+    gateway = GatewayProxy(shard_id, request_queue)
+    scheduler = TimerWheel()
+    scheduler.start()
+    reader = SharedCandleReader() if shared_candles else None
+    monitors = {}
+    for product_id, granularity in markets:
+        cm = CryptoMonitor(gateway, product_id, granularity)
+        cm.parameters = parameters.get((product_id, granularity), DEFAULT_PARAMETERS)
+        cm.scheduler = scheduler
+        if reader is not None:
+            cm.candle_ring = reader.get_ring(product_id, granularity)
+        monitors[monitor_address(product_id, granularity)] = cm
+        cm.start()
+    logger.info(f"Shard {shard_id} running {len(monitors)} monitors")
+    while True:
+        item = response_queue.get()
+        if item is None:
+            break
+        address, wire = item
+        monitor = monitors.get(address)
+        if monitor is not None:
+            monitor.add_message_to_queue(message_from_bytes(wire, gateway, monitor))
+    for monitor in monitors.values():
+        monitor.stop()
+    for monitor in monitors.values():
+        monitor.join()
+    scheduler.stop()
+    if reader is not None:
+        reader.close()
+
+
+# Spreads the monitors over `processes` shard processes, each running its
+# monitors as threads, with every API call going through one gateway
+# process so the rate limits stay global. With shared_candles the candle
+# series live in shared memory rings owned by this process, written by the
+# gateway and attached to by the shards.
+class ShardedRuntime(object):
+
+    def __init__(self, key_file, processes=None, granularities=(3600,),
+                 request_concurrency=1, parameters=None, markets=None, shared_candles=False):
+        self.key_file = key_file
+        self.processes = processes or multiprocessing.cpu_count()
+        self.request_concurrency = request_concurrency
+        self.parameters = parameters or {}
+        if markets is None:
+            markets = [(f"{crypto}-USD", granularity) for crypto in FIAT_MARKETS for granularity in granularities]
+        self.markets = markets
+        self.shards = [markets[i::self.processes] for i in range(self.processes)]
+        self.publisher = SharedCandlePublisher() if shared_candles else None
+        self.request_queue = multiprocessing.Queue()
+        self.response_queues = [multiprocessing.Queue() for _ in self.shards]
+        self.gateway = None
+        self.workers = []
+
+    def start(self):
+        shared_markets = None
+        if self.publisher is not None:
+            for product_id, granularity in self.markets:
+                self.publisher.get_ring(product_id, granularity)
+            shared_markets = self.markets
+        self.gateway = multiprocessing.Process(
+            target=run_gateway,
+            args=(self.key_file, self.request_queue, self.response_queues, self.request_concurrency, shared_markets),
+            name='ApiGateway',
+        )
+        self.gateway.start()
+        for shard_id, markets in enumerate(self.shards):
+            shard_parameters = {key: self.parameters[key] for key in markets if key in self.parameters}
+            worker = multiprocessing.Process(
+                target=run_shard,
+                args=(shard_id, markets, self.request_queue, self.response_queues[shard_id], shard_parameters,
+                      self.publisher is not None),
+                name=f"MonitorShard-{shard_id}",
+            )
+            worker.start()
+            self.workers.append(worker)
+
+    def join(self):
+        for worker in self.workers:
+            worker.join()
+
+    # The rings are unlinked even if a join is interrupted, otherwise they
+    # outlive the process
+    def stop(self):
+        try:
+            for response_queue in self.response_queues:
+                response_queue.put(None)
+            self.join()
+            if self.gateway is not None:
+                self.request_queue.put(None)
+                self.gateway.join()
+        finally:
+            if self.publisher is not None:
+                self.publisher.close()
+
+
+if __name__ == "__main__":
+    runtime = ShardedRuntime('3600coinbasebot.key', shared_candles='--shared-candles' in sys.argv)
+    try:
+        runtime.start()
+        runtime.join()
+    finally:
+        runtime.stop()
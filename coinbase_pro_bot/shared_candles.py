@@ -0,0 +1,200 @@
+from multiprocessing import shared_memory
+from time import sleep
+
+import numpy as np
+
+from candle_store import CandleSeries
+from crypto_message import CandleUpdateMessage
+
+DEFAULT_CAPACITY = 4096
+# A reader retries a torn read this many times, yielding for the first few
+# and then sleeping READ_BACKOFF seconds, before deciding the writer died
+# mid write
+MAX_READ_ATTEMPTS = 100
+SPIN_READ_ATTEMPTS = 10
+READ_BACKOFF = 0.001
+
+HEADER_FIELDS = 4
+SEQUENCE, COUNT, END, CAPACITY = range(HEADER_FIELDS)
+COLUMNS = CandleSeries.__slots__
+COLUMN_DTYPES = [np.int64] + [np.float64]*(len(COLUMNS) - 1)
+
+
+def shared_name(product_id, granularity):
+    return f"cpb_{product_id}_{granularity}"
+
+
+class RingBusy(Exception):
+    pass
+
+
+# Calls read() until it ran without the writer touching the ring in the
+# meantime and returns its result
+def consistent_read(ring, read, attempts=MAX_READ_ATTEMPTS):
+    for attempt in range(attempts):
+        before = ring.sequence()
+        if before % 2 == 0:
+            result = read()
+            if ring.sequence() == before:
+                return result
+        sleep(0 if attempt < SPIN_READ_ATTEMPTS else READ_BACKOFF)
+    raise RingBusy(f"ring stayed mid write for {attempts} reads")
+
+
+# Fixed capacity OHLCV ring in one shared memory block. Every value is written
+# twice, at i and i + capacity, so the newest `count` candles are always one
+# contiguous slice and readers can take numpy views without copying. Writes
+# are bracketed by a sequence number (odd while writing) so readers can tell
+# when a view was torn by a concurrent write.
+class SharedCandleRing(object):
+
+    def __init__(self, shm, capacity, owner):
+        self.shm = shm
+        self.capacity = capacity
+        self.owner = owner
+        self.header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        self.columns = {}
+        offset = self.header.nbytes
+        for col, dtype in zip(COLUMNS, COLUMN_DTYPES):
+            self.columns[col] = np.ndarray((2*capacity,), dtype=dtype, buffer=shm.buf, offset=offset)
+            offset += self.columns[col].nbytes
+
+    @staticmethod
+    def size_for(capacity):
+        return 8*HEADER_FIELDS + sum(np.dtype(d).itemsize*2*capacity for d in COLUMN_DTYPES)
+
+    @classmethod
+    def create(cls, name, capacity=DEFAULT_CAPACITY):
+        shm = shared_memory.SharedMemory(name=name, create=True, size=cls.size_for(capacity))
+        ring = cls(shm, capacity, True)
+        ring.header[:] = 0
+        ring.header[CAPACITY] = capacity
+        return ring
+
+    @classmethod
+    def attach(cls, name):
+        # The rings are owned by the main process, which unlinks them on
+        # shutdown; readers only map the block. The capacity comes from the
+        # header because shm.size may be rounded up to a whole page
+        shm = shared_memory.SharedMemory(name=name)
+        header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        capacity = int(header[CAPACITY])
+        del header
+        return cls(shm, capacity, False)
+
+    def __len__(self):
+        return int(self.header[COUNT])
+
+    def sequence(self):
+        return int(self.header[SEQUENCE])
+
+    def write_row(self, index, values):
+        for col, value in zip(COLUMNS, values):
+            column = self.columns[col]
+            column[index] = value
+            column[index + self.capacity] = value
+
+    def append(self, timestamp, open, high, low, close, volume):
+        self.header[SEQUENCE] += 1
+        end = int(self.header[END])
+        self.write_row(end % self.capacity, (timestamp, open, high, low, close, volume))
+        self.header[END] = end + 1
+        self.header[COUNT] = min(int(self.header[COUNT]) + 1, self.capacity)
+        self.header[SEQUENCE] += 1
+
+    def extend(self, candles):
+        last = self.last_timestamp()
+        for i in np.flatnonzero(candles.timestamp > last):
+            self.append(*[getattr(candles, col)[i] for col in COLUMNS])
+
+    def last_timestamp(self):
+        if len(self) == 0:
+            return 0
+        return int(self.columns['timestamp'][(int(self.header[END]) - 1) % self.capacity])
+
+    # Zero-copy views of the newest candles, oldest first. They stay valid
+    # only while sequence() is unchanged.
+    def view(self):
+        count = int(self.header[COUNT])
+        start = (int(self.header[END]) - count) % self.capacity
+        return CandleSeries(*[self.columns[col][start:start+count] for col in COLUMNS])
+
+    # Consistent private copy, retried while the writer is mid-update
+    def snapshot(self):
+        return self.since(0)
+
+    # Consistent private copy of the candles newer than timestamp
+    def since(self, timestamp):
+        def read():
+            view = self.view()
+            start = np.searchsorted(view.timestamp, timestamp, side='right')
+            return CandleSeries(*[getattr(view, col)[start:].copy() for col in COLUMNS])
+        return consistent_read(self, read)
+
+    def close(self):
+        self.header = None
+        self.columns = {}
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+# Runs in the ingest process: holds one ring per product/granularity, is
+# handed REST history through publish() and registered with CandleBuilders in
+# place of a monitor, so every consumer reads the same copy of each series.
+# With create=False it writes to rings another process created and owns.
+class SharedCandlePublisher(object):
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, create=True):
+        self.capacity = capacity
+        self.create = create
+        self.rings = {}
+
+    def __str__(self):
+        return f"SharedCandlePublisher({len(self.rings)} series)"
+
+    def get_ring(self, product_id, granularity):
+        key = (product_id, granularity)
+        if key not in self.rings:
+            name = shared_name(product_id, granularity)
+            if self.create:
+                self.rings[key] = SharedCandleRing.create(name, self.capacity)
+            else:
+                self.rings[key] = SharedCandleRing.attach(name)
+        return self.rings[key]
+
+    def publish(self, product_id, granularity, candles):
+        self.get_ring(product_id, granularity).extend(candles)
+
+    def add_message_to_queue(self, msg):
+        if isinstance(msg, CandleUpdateMessage):
+            candle = msg.candle
+            self.get_ring(msg.sender.product_id, msg.granularity).append(
+                candle.start, candle.open, candle.high, candle.low, candle.close, candle.volume
+            )
+
+    def close(self):
+        for ring in self.rings.values():
+            ring.close()
+        self.rings = {}
+
+
+# Used inside monitor worker processes to attach to the series they evaluate
+class SharedCandleReader(object):
+
+    def __init__(self):
+        self.rings = {}
+
+    def get_ring(self, product_id, granularity):
+        key = (product_id, granularity)
+        if key not in self.rings:
+            self.rings[key] = SharedCandleRing.attach(shared_name(product_id, granularity))
+        return self.rings[key]
+
+    def snapshot(self, product_id, granularity):
+        return self.get_ring(product_id, granularity).snapshot()
+
+    def close(self):
+        for ring in self.rings.values():
+            ring.close()
+        self.rings = {}
@@ -1,4 +1,6 @@
 
+import os
+from collections import namedtuple
 from datetime import datetime, timezone
 
 BASE_CSV_DATA = "market_data/"
@@ -45,6 +47,9 @@ FIAT_MARKETS = [
 
 GRANULARITIES = [60, 300, 900, 3600, 21600, 86400]
 
+# Most candles get_product_historic_rates returns for one request
+MAX_CANDLES_PER_REQUEST = 300
+
 
 STATE_DEFAULT = 0
 STATE_OVERBOUGHT = 1
@@ -57,19 +62,68 @@ STATE_BUY = 6
 RSI_OVERSOLD_THRESHOLD = 30
 RSI_OVERBOUGHT_THRESHOLD = 70
 
+# Markets whose price trend slope, relative to the current price, falls below
+# this are not traded
+TREND_SLOPE_THRESHOLD = -0.0005
+
+MAX_INVESTMENT = 10
+
+StrategyParameters = namedtuple('StrategyParameters', [
+    'rsi_oversold',
+    'rsi_overbought',
+    'rsi_period',
+    'macd_fast',
+    'macd_slow',
+    'macd_signal',
+    'trend_threshold',
+])
+
+DEFAULT_PARAMETERS = StrategyParameters(
+    rsi_oversold=RSI_OVERSOLD_THRESHOLD,
+    rsi_overbought=RSI_OVERBOUGHT_THRESHOLD,
+    rsi_period=14,
+    macd_fast=12,
+    macd_slow=26,
+    macd_signal=9,
+    trend_threshold=TREND_SLOPE_THRESHOLD,
+)
+
+
+# Epoch seconds as the ISO 8601 UTC time the exchange API takes and returns
+def isoformat(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
+
 
 def generate_file_name(pair, granularity):
-    return f"{BASE_CSV_DATA}/{pair}-{granularity}.csv"
+    return os.path.join(BASE_CSV_DATA, f"{pair}-{granularity}.csv")
+
+
+def generate_binary_file_name(pair, granularity):
+    return os.path.join(BASE_CSV_DATA, f"{pair}-{granularity}.candles")
+
+
+# Reads backwards from the end of the file in fixed size blocks, so finding
+# the last line doesn't depend on how large the file has grown
+def read_last_line(file_name, block_size=1024):
+    with open(file_name, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b''
+        while position > 0:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+            lines = data.rstrip(b'\r\n').split(b'\n')
+            if len(lines) > 1 or position == 0:
+                return lines[-1].decode()
+        return ''
 
 
 def get_newest_saved_time(pair, granularity):
     file_name = generate_file_name(pair, granularity)
     try:
-        with open(file_name, 'r') as f:
-            lines = f.readlines()
-            if len(lines) == 0:
-                return datetime.fromtimestamp(0, tz=timezone.utc)
-            last_timestamp = int(lines[-1].split(',')[0])
-            return datetime.fromtimestamp(last_timestamp, tz=timezone.utc)
-    except FileNotFoundError:
+        last_timestamp = int(read_last_line(file_name).split(',')[0])
+        return datetime.fromtimestamp(last_timestamp, tz=timezone.utc)
+    except (FileNotFoundError, ValueError):
         return datetime.fromtimestamp(0, tz=timezone.utc)
\ No newline at end of file
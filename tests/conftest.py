@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The bot's modules import each other by bare name, as when run from inside
+# coinbase_pro_bot/
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'coinbase_pro_bot'))
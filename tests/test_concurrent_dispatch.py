@@ -0,0 +1,106 @@
+import http.client
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from api_request_manager import ApiRequestManager
+from crypto_message import HistoricalDataRequestMessage, HistoricalDataResponseMessage
+from rate_limiter import RateLimiter, PUBLIC_ENDPOINT, PRIVATE_ENDPOINT
+
+MARKETS = 37
+LATENCY = 0.1
+CONCURRENCY = 8
+
+
+class StubExchangeHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        sleep(LATENCY)
+        granularity = int(parse_qs(urlparse(self.path).query)['granularity'][0])
+        body = json.dumps([[granularity*(300 - i), 1.0, 2.0, 1.5, 1.5, 10.0] for i in range(300)]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Talks to the stub over one keep-alive connection, like the session inside
+# a cbpro client
+class StubExchangeClient(object):
+
+    def __init__(self, host, port):
+        self.connection = http.client.HTTPConnection(host, port)
+
+    def get_product_historic_rates(self, product_id, start=None, end=None, granularity=None):
+        self.connection.request('GET', f"/products/{product_id}/candles?granularity={granularity}")
+        return json.loads(self.connection.getresponse().read())
+
+
+class ResponseCollector(object):
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.responses = []
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def add_message_to_queue(self, msg):
+        with self.lock:
+            self.responses.append(msg)
+            if len(self.responses) == self.expected:
+                self.done.set()
+
+
+@pytest.fixture
+def stub_exchange():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubExchangeHandler)
+    server.connections = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+# Seconds to fetch one history window per market, as on a cold start
+def warm_up(server, concurrency):
+    host, port = server.server_address
+    manager = ApiRequestManager(None, concurrency, lambda: StubExchangeClient(host, port))
+    # Limits high enough that only the dispatch mode decides the timing
+    manager.rate_limiter = RateLimiter({PUBLIC_ENDPOINT: (1000, 1000), PRIVATE_ENDPOINT: (1000, 1000)})
+    collector = ResponseCollector(MARKETS)
+    manager.start()
+    started = monotonic()
+    for i in range(MARKETS):
+        manager.add_message_to_queue(HistoricalDataRequestMessage(collector, manager, f"SYN{i}-USD", granularity=3600))
+    assert collector.done.wait(MARKETS*LATENCY*5)
+    elapsed = monotonic() - started
+    manager.stop()
+    manager.join()
+    assert all(isinstance(msg, HistoricalDataResponseMessage) and len(msg.data) == 300 for msg in collector.responses)
+    return elapsed
+
+
+def test_warm_up_scales_with_concurrency(stub_exchange):
+    serial = warm_up(stub_exchange, 1)
+    assert serial >= MARKETS*LATENCY
+    assert len(stub_exchange.connections) == 1
+
+    stub_exchange.connections.clear()
+    concurrent = warm_up(stub_exchange, CONCURRENCY)
+    # O(markets/concurrency) round trips, with slack for a loaded machine
+    assert concurrent < 2*(MARKETS/CONCURRENCY + 1)*LATENCY
+    assert concurrent < serial/3
+    # Pooled clients keep their connections alive
+    assert len(stub_exchange.connections) <= CONCURRENCY